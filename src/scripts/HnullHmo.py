@@ -1,24 +1,82 @@
 """ Plot sub- and super-runaway planets in the sample and the corresponding hypotheses in instellation-radius space."""
 
-import pickle
+import functools
 import paths
+import artifacts
 import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
 from matplotlib.ticker import ScalarFormatter
 from bioverse.hypothesis import magma_ocean_hypo, magma_ocean_f0
 from bioverse.util import S2a_eff, a_eff2S
 from bioverse.constants import CONST
+from utils import get_f_dR
+from columnar import load_subsample
 
 import plotstyle
 plotstyle.styleplots()
 
 
+class SampleSelection:
+    """Selection masks and group statistics of a sample, computed once and shared by all panels.
+
+    Parameters
+    ----------
+    sample : Bioverse Table or pandas DataFrame
+        Table with the synthetic sample
+    planets_args : dict
+        arguments for planet sample creation with Bioverse
+    """
+
+    def __init__(self, sample, planets_args):
+        try:
+            self.df = sample.to_pandas()
+        except AttributeError:
+            self.df = sample
+        self.transiting = self.df['transiting'].to_numpy(dtype=bool)
+        self.has_magmaocean = self.df['has_magmaocean'].to_numpy(dtype=bool)
+        self.below_thresh = self.df['S_abs'].to_numpy() < planets_args['S_thresh']
+        self.transiting_out = self.transiting & self.below_thresh
+
+    def column(self, key, mask=None):
+        col = self.df[key].to_numpy()
+        return col if mask is None else col[mask]
+
+    @functools.cached_property
+    def R_avg_out(self):
+        """average radius of transiting planets below the threshold instellation."""
+        return np.average(self.column('R', self.transiting_out))
+
+    @functools.cached_property
+    def rho_avg_out(self):
+        """average bulk density of transiting planets below the threshold instellation."""
+        return np.average(CONST['rho_Earth'] * self.column('M', self.transiting_out) /
+                          self.column('R', self.transiting_out) ** 3)
+
+    @functools.cached_property
+    def radius_change(self):
+        """average fractional radius change of planets with a magma ocean."""
+        return np.average(self.column('R', self.has_magmaocean) / self.column('R_orig', self.has_magmaocean)) - 1
+
+    @functools.cached_property
+    def density_change(self):
+        """average fractional density change of planets with a magma ocean."""
+        return np.average(self.column('rho', self.has_magmaocean) /
+                          (CONST['rho_Earth'] * self.column('M', self.has_magmaocean) /
+                           self.column('R_orig', self.has_magmaocean) ** 3)) - 1
+
+
+def get_selection(sample, planets_args):
+    """wrap a sample in a `SampleSelection` unless it already is one."""
+    return sample if isinstance(sample, SampleSelection) else SampleSelection(sample, planets_args)
+
+
 def plot_transitingplanets(sample, planets_args, ax, parameter_of_interest='R'):
     """ Make a scatter plot highlighting the transiting planets.
 
     Parameters
     ----------
-    sample : Bioverse Table or pandas DataFrame
+    sample : Bioverse Table, pandas DataFrame or SampleSelection
         Table with the synthetic sample
     planets_args : dict
         arguments for planet sample creation with Bioverse
@@ -32,38 +90,29 @@ def plot_transitingplanets(sample, planets_args, ax, parameter_of_interest='R'):
         the axis with the plot
     """
     yvar = parameter_of_interest
+    sel = get_selection(sample, planets_args)
+    S_abs, y = sel.column('S_abs'), sel.column(yvar)
 
-    try:
-        sampledf = sample.to_pandas()
-    except AttributeError:
-        sampledf = sample
-    ax.scatter(sampledf[sampledf.transiting == False].S_abs, sampledf[sampledf.transiting == False][yvar], s=.3,
+    ax.scatter(S_abs[~sel.transiting], y[~sel.transiting], s=.3,
                c='dimgray', alpha=.5, label='synthetic\nplanets')
 
     # transiting planets
     # sc = ax.scatter(sampledf[sampledf.transiting == True].S_abs, sampledf[sampledf.transiting == True][yvar], s=20,
     #            marker='x', c=np.where(sampledf[sampledf.transiting == True].has_magmaocean, 'C2', 'C0'), label='transiting')
-    ax.scatter(sampledf[(sampledf.transiting) & ~(sampledf.has_magmaocean)].S_abs, sampledf[(sampledf.transiting) & ~(sampledf.has_magmaocean)][yvar], s=50,
+    transiting_nomo = sel.transiting & ~sel.has_magmaocean
+    transiting_mo = sel.transiting & sel.has_magmaocean
+    ax.scatter(S_abs[transiting_nomo], y[transiting_nomo], s=50,
                     marker='X', c='C0', edgecolors='k', linewidth=1.25, label='transiting')
-    ax.scatter(sampledf[(sampledf.transiting) & (sampledf.has_magmaocean)].S_abs, sampledf[(sampledf.transiting) & (sampledf.has_magmaocean)][yvar], s=50,
+    ax.scatter(S_abs[transiting_mo], y[transiting_mo], s=50,
                     marker='X', c='C2', edgecolors='k', linewidth=1.25, label='transiting, RGH')
 
-    # show differences in radius due to magma ocean
+    # show differences in radius due to magma ocean: one vertical segment per transiting planet whose radius changed
     if yvar == 'R':
-        X_coords = np.array([sampledf[sampledf.transiting == True].S_abs, sampledf[sampledf.transiting == True].S_abs])
-        Y_coords = np.array([sampledf[sampledf.transiting == True].R_orig, sampledf[sampledf.transiting == True].R])
-        ax.plot(X_coords, Y_coords, c='gray', lw=1.5, alpha=.5, zorder=-1)
-
-        for i in range(len(sampledf[sampledf.transiting == True])):
-            if Y_coords[1][i] != Y_coords[0][i]:
-                ax.annotate(
-                    "",
-                    xy=(X_coords[0][i], Y_coords[1][i]), xytext=(0, -1.),  # xytext=(0., Y_coords[1][i]),
-                    textcoords='offset points', ha='right', va='bottom',
-                    bbox=dict(boxstyle='round,pad=0.5', alpha=0.5),
-                    arrowprops=dict(arrowstyle='-', connectionstyle='arc3,rad=0', alpha=.5, lw=1.5),
-                    zorder=-9
-                )
+        R_orig = sel.column('R_orig')
+        changed = sel.transiting & (y != R_orig)
+        segments = np.stack([np.column_stack([S_abs[changed], R_orig[changed]]),
+                             np.column_stack([S_abs[changed], y[changed]])], axis=1)
+        ax.add_collection(LineCollection(segments, colors='gray', lw=1.5, alpha=.5, zorder=-1), autolim=False)
 
         ax.set_ylabel('Radius [$R_\oplus$]')
     elif yvar == 'rho':
@@ -85,7 +134,7 @@ def plot_HnullHmo(sample, planets_args, ax, parameter_of_interest='R', f_dR=None
 
     Parameters
     ----------
-    sample : Bioverse Table or pandas DataFrame
+    sample : Bioverse Table, pandas DataFrame or SampleSelection
         Table with the synthetic sample
     planets_args : dict
         arguments for planet sample creation with Bioverse
@@ -102,21 +151,10 @@ def plot_HnullHmo(sample, planets_args, ax, parameter_of_interest='R', f_dR=None
     S_grid = np.linspace(30., 2000., 250)
     a_eff_grid = S2a_eff(S_grid)
 
-    R_avg_out = np.average(sample['R'][(sample['S_abs'] < planets_args['S_thresh']) & sample['transiting']])
-
-    rho_avg_out = np.average(CONST['rho_Earth'] * sample['M'][(sample['S_abs'] < planets_args['S_thresh']) & sample['transiting']] /
-                             (sample['R'][(sample['S_abs'] < planets_args['S_thresh']) & sample['transiting']]) ** 3)
-
-    try:
-        dd = sample.to_pandas()
-    except AttributeError:
-        dd = sample
-    mo = dd[dd.has_magmaocean]
-
+    sel = get_selection(sample, planets_args)
 
     if parameter_of_interest == 'R':
-        # compute radius change
-        radius_change = np.average(mo.R / mo.R_orig) - 1
+        R_avg_out, radius_change = sel.R_avg_out, sel.radius_change
         P_magma = magma_ocean_hypo((planets_args['S_thresh'], planets_args['wrr'], planets_args['f_rgh'], R_avg_out), a_eff_grid,
                                    gh_increase=planets_args['gh_increase'], water_incorp=planets_args['water_incorp'],
                                    simplified=planets_args['simplified'], diff_frac=radius_change,
@@ -125,8 +163,7 @@ def plot_HnullHmo(sample, planets_args, ax, parameter_of_interest='R', f_dR=None
         P0 = magma_ocean_f0(R_avg_out, a_eff_grid)
 
     elif parameter_of_interest == 'rho':
-        # compute density change
-        density_change = np.average(mo.rho / (CONST['rho_Earth'] * mo.M / mo.R_orig ** 3)) - 1
+        rho_avg_out, density_change = sel.rho_avg_out, sel.density_change
         P_magma = magma_ocean_hypo((planets_args['S_thresh'], planets_args['wrr'], planets_args['f_rgh'], rho_avg_out), a_eff_grid,
                                    diff_frac=density_change,
                                    parameter_of_interest=parameter_of_interest, f_dR=f_dR)
@@ -185,7 +222,8 @@ def draw_Sthresh(ax, planets_args):
     return ax
 
 def plot_has_magmaocean(sample, ax):
-    sample = sample.sample(3000, random_state=42)
+    if len(sample) > 3000:
+        sample = sample.sample(3000, random_state=42)
 
     for has_MO, color in zip([False, True], ['C0', 'C2']):
         x, y = sample[sample['has_magmaocean'] == has_MO]['P'], sample[sample['has_magmaocean'] == has_MO]['has_magmaocean']
@@ -213,25 +251,34 @@ def plot_has_magmaocean(sample, ax):
     return ax
 
 
-def main(sample, planets_args, parameter_of_interest, f_dR=None):
+def main(sample, planets_args, parameter_of_interest, f_dR=None, sample_small=None):
     # sample from the sample for a less cluttered plot
-    sample_df = sample.to_pandas().sample(min(15000, len(sample)), random_state=42)
+    try:
+        sample_df = sample.to_pandas().sample(min(15000, len(sample)), random_state=42)
+    except AttributeError:
+        # already subsampled, see columnar.load_subsample
+        sample_df = sample
+    if sample_small is None:
+        sample_small = sample_df
+    # masks and averages shared by both panels
+    selection = SampleSelection(sample_df, planets_args)
 
 
     fig, (ax, ax2) = plt.subplots(nrows=2, gridspec_kw={'height_ratios': [1.5, 6]}, figsize=[10.36, 6.4])
-    ax = plot_has_magmaocean(sample_df, ax)
+    ax = plot_has_magmaocean(sample_small, ax)
     ax2 = draw_Sthresh(ax2, planets_args)
-    ax2 = plot_transitingplanets(sample_df, planets_args, ax2, parameter_of_interest=parameter_of_interest)
-    ax2 = plot_HnullHmo(sample_df, planets_args, ax2, parameter_of_interest=parameter_of_interest, f_dR=f_dR)
+    ax2 = plot_transitingplanets(selection, planets_args, ax2, parameter_of_interest=parameter_of_interest)
+    ax2 = plot_HnullHmo(selection, planets_args, ax2, parameter_of_interest=parameter_of_interest, f_dR=f_dR)
     ax.set_title('Synthetic planets', y=1.35, fontsize=14)
     fig.tight_layout(h_pad=2.)
 
     fig.savefig(paths.figures / "HnullHmo.pdf")
     return fig, (ax, ax2)
 
-with open(paths.data / 'pipeline/planets_args.pkl', 'rb') as f:
-    planets_args = pickle.load(f)
-with open(paths.data / 'pipeline/sample.pkl', 'rb') as f:
-    sample = pickle.load(f)
+planets_args = artifacts.load('planets_args')
+# load only the plotted columns of the stratified subsamples written by the pipeline
+sample = load_subsample('all_15000', columns=['S_abs', 'R', 'R_orig', 'M', 'rho', 'transiting', 'has_magmaocean'])
+sample_small = load_subsample('all_3000', columns=['P', 'has_magmaocean'])
 
-main(sample, planets_args, parameter_of_interest='R', f_dR=None)
\ No newline at end of file
+f_dR = get_f_dR(planets_args['gh_increase'], planets_args['water_incorp'], parameter_of_interest='R')
+main(sample, planets_args, parameter_of_interest='R', f_dR=f_dR, sample_small=sample_small)
\ No newline at end of file
@@ -1,7 +1,7 @@
 """Explore inference with alternative mass-radius relations"""
 
-import pickle
 import paths
+import artifacts
 import numpy as np
 import pandas as pd
 from matplotlib.transforms import blended_transform_factory
@@ -9,6 +9,7 @@ from matplotlib.transforms import blended_transform_factory
 import plotstyle
 plotstyle.styleplots()
 import seaborn as sns
+from columnar import load_grid
 
 
 def plot_splitviolin(planets_args, res_fg_MR_earthlike, res_fg_MR_Wolfgang2016):
@@ -66,18 +67,15 @@ def plot_splitviolin(planets_args, res_fg_MR_earthlike, res_fg_MR_Wolfgang2016):
     return ax
 
 
-with open(paths.data / 'pipeline/planets_args.pkl', 'rb') as f:
-    planets_args = pickle.load(f)
+planets_args = artifacts.load('planets_args')
 
 # load previously computed hypothesis test grids
 hypothesisgrids = {'res_fg_MR_Wolfgang2016':'optimistic_MR_Wolfgang2016.pkl',
                    'res_fg_MR_earthlike':'optimistic_MR_earthlike.pkl',
                    'res_optimistic_H2O_fg':'optimistic_H2O-f-grid.pkl'}
-for varname, path in zip(hypothesisgrids.keys(),
-                         [str(paths.data) + '/bioverse_objects/' + fname for fname in hypothesisgrids.values()]):
-    with open(path, 'rb') as f:
-        loaded_obj = pickle.load(f)
-        exec(varname + '= loaded_obj')
+for varname, fname in hypothesisgrids.items():
+    loaded_obj = load_grid(fname)
+    exec(varname + '= loaded_obj')
 
 ax = plot_splitviolin(planets_args, res_fg_MR_earthlike, res_fg_MR_Wolfgang2016)
 
@@ -0,0 +1,46 @@
+"""
+Shared loader for the pipeline artifacts in `src/data/pipeline`.
+
+Each artifact is unpickled at most once per process. The figure driver (build_figures.py) preloads the artifacts
+in its main process, so that the forked processes rendering the figures find them already in memory.
+"""
+
+import os
+import pickle
+import paths
+
+pipeline_dir = paths.data / 'pipeline'
+
+# artifacts loaded in this process, by name
+_loaded = {}
+
+
+def artifact_file(name):
+    """path of the pickled pipeline artifact `name`, e.g. 'planets_args'."""
+    return pipeline_dir / (name + '.pkl')
+
+
+def load(name):
+    """Load a pipeline artifact, unpickling it only on first use.
+
+    Parameters
+    ----------
+    name : str
+        name of the artifact, e.g. 'planets_args' for src/data/pipeline/planets_args.pkl
+
+    Returns
+    -------
+    obj
+        the unpickled artifact. Shared between all callers in this process; do not modify it in place.
+    """
+    if name not in _loaded:
+        with open(artifact_file(name), 'rb') as f:
+            _loaded[name] = pickle.load(f)
+    return _loaded[name]
+
+
+def preload(names):
+    """Load all existing artifacts in `names`, skipping the ones that have not been written."""
+    for name in names:
+        if os.path.exists(artifact_file(name)):
+            load(name)
@@ -0,0 +1,225 @@
+"""
+Benchmark the stages of the pipeline and the figure scripts, and track their performance across commits.
+
+Each case runs in a fresh process and records wall time, peak memory (RSS) and throughput. The peak memory of a
+stage is measured after its inputs are prepared (on Linux, by resetting the high-water mark of the process), so
+that regressions of the survey and fit stages are not hidden by the sample generation before them. The sample and
+survey stages are timed at several values of `M_min` (which tunes the sample size), the hypothesis test at several
+nested sampling budgets `nlive`. Results are appended to a history file (one JSON record per line) and compared to
+the median of the previous commits to flag regressions.
+
+Usage:
+    python benchmark.py [--stages sample,survey,fit,figures] [--M-min 0.2,0.32,0.5] [--nlive 100,250,500]
+"""
+
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import datetime
+import subprocess
+import multiprocessing
+import numpy as np
+import paths
+
+history_file = paths.data / 'benchmarks/history.jsonl'
+
+BENCHMARK_STAGES = ('sample', 'survey', 'fit', 'figures')
+
+FIGURE_SCRIPTS = ('HnullHmo.py', 'cornerplot.py', 'optimistic_RS.py', 'radiusevolution.py', 'MR_violins.py',
+                  'optimistic_statpwr_H2O-f.py', 'plato_grids.py', 'plato_Sthresh_grid.py')
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """peak resident set size in MB."""
+    maxrss = resource.getrusage(who).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return maxrss / 1024 ** 2 if sys.platform == 'darwin' else maxrss / 1024
+
+
+def _proc_status_mb(field):
+    """a memory field of /proc/self/status in MB, or None where it is not available."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """Reset the peak RSS (VmHWM) of this process to its current RSS. Linux only.
+
+    Returns
+    -------
+    success : bool
+        whether the peak was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return _proc_status_mb('VmHWM') is not None
+
+
+def _run_case(stage, param, value):
+    """run one benchmark case. Executed in a fresh process, so that peak memory is attributable to the case."""
+    if stage == 'figures':
+        t_start = time.time()
+        subprocess.run([sys.executable, str(paths.scripts / value)], cwd=paths.scripts, check=True,
+                       stdout=subprocess.DEVNULL)
+        peak = peak_rss_mb(resource.RUSAGE_CHILDREN)
+        return {'wall_time': time.time() - t_start, 'peak_rss_mb': peak, 'stage_peak_rss_mb': peak}
+
+    import hzied_pipeline as pipeline
+
+    gen_kwargs = {'M_min': value} if param == 'M_min' else {}
+    _, planets_args = pipeline.get_generator_args()
+    planets_args.update(gen_kwargs)
+
+    # untimed preparation of the inputs of the benchmarked stage
+    if stage != 'sample':
+        sample, g_transit = pipeline.generate_sample(**gen_kwargs)
+    if stage == 'fit':
+        detected, data, survey = pipeline.survey_simulation(sample)
+    # peak memory of the stage alone, not of the preparation above
+    reset = reset_peak_rss()
+    rss_before = _proc_status_mb('VmRSS') if reset else peak_rss_mb()
+
+    t_start = time.time()
+    if stage == 'sample':
+        sample, g_transit = pipeline.generate_sample(**gen_kwargs)
+        n, n_evals = len(sample), len(sample)
+    elif stage == 'survey':
+        detected, data, survey = pipeline.survey_simulation(sample)
+        n, n_evals = len(data), len(data)
+    elif stage == 'fit':
+        hypothesis_args = pipeline.get_hypothesis_args('R')
+        hypothesis_args['nlive'] = value
+        results, h_magmaocean = pipeline.hypotest(data, 'R', planets_args=planets_args, **hypothesis_args)
+        n, n_evals = len(data), int(np.sum(results['sampler_results'].ncall))
+    wall_time = time.time() - t_start
+    stage_peak = _proc_status_mb('VmHWM') if reset else None
+
+    return {'wall_time': wall_time,
+            'peak_rss_mb': peak_rss_mb(),
+            'stage_peak_rss_mb': stage_peak,
+            'rss_increase_mb': max(0., (stage_peak if reset else peak_rss_mb()) - rss_before),
+            'evals_per_sec': n_evals / wall_time,
+            'N': n}
+
+
+def get_cases(stages, M_min_values, nlive_values):
+    """list of (stage, swept parameter, value). Each parameter is swept on its own."""
+    cases = []
+    for stage in stages:
+        if stage in ('sample', 'survey'):
+            cases += [(stage, 'M_min', M_min) for M_min in M_min_values]
+        elif stage == 'fit':
+            cases += [(stage, 'nlive', nlive) for nlive in nlive_values]
+        elif stage == 'figures':
+            cases += [(stage, 'script', script) for script in FIGURE_SCRIPTS]
+    return cases
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=paths.root, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(filename=history_file):
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def find_regressions(record, history, tolerance=0.2):
+    """Compare a record to the median of previous commits for the same case.
+
+    Returns
+    -------
+    regressions : list of str
+        description of every metric that got worse by more than `tolerance`
+    """
+    previous = [r for r in history if (r['stage'], r['param'], r['value']) == (record['stage'], record['param'],
+                                                                               record['value'])
+                and r['commit'] != record['commit']]
+    regressions = []
+    # memory is compared on the peak of the stage itself; fall back to the process peak where it is unknown
+    memory = 'stage_peak_rss_mb' if record.get('stage_peak_rss_mb') is not None else 'peak_rss_mb'
+    for metric in ('wall_time', memory):
+        values = [r[metric] for r in previous if r.get(metric) is not None]
+        if values and record[metric] > (1 + tolerance) * np.median(values):
+            regressions.append('{} {}={}: {} {:.1f} vs. median {:.1f}'.format(
+                record['stage'], record['param'], record['value'], metric, record[metric], np.median(values)))
+    return regressions
+
+
+def run_benchmarks(stages=BENCHMARK_STAGES, M_min_values=(0.2, 0.32, 0.5), nlive_values=(100, 250, 500),
+                   tolerance=0.2, filename=history_file):
+    """Run all benchmark cases, append them to the history file and report regressions.
+
+    Returns
+    -------
+    records : list of dict
+        one record per case
+    regressions : list of str
+        cases that got slower or use more memory than before
+    """
+    history = load_history(filename)
+    try:
+        from importlib.metadata import version
+        bioverse_version = version('bioverse')
+    except Exception:
+        bioverse_version = None
+    commit = git_commit()
+
+    records, regressions = [], []
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    ctx = multiprocessing.get_context('spawn')
+    for stage, param, value in get_cases(stages, M_min_values, nlive_values):
+        with ctx.Pool(1) as pool:
+            result = pool.apply(_run_case, (stage, param, value))
+        record = {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+                  'commit': commit,
+                  'bioverse_version': bioverse_version,
+                  'stage': stage, 'param': param, 'value': value}
+        record.update(result)
+        print('{stage} {param}={value}: {wall_time:.1f} s, {peak_rss_mb:.0f} MB'.format(**record))
+
+        regressions += find_regressions(record, history, tolerance)
+        with open(filename, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        records.append(record)
+
+    for regression in regressions:
+        print('REGRESSION: ' + regression)
+    return records, regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages and figure scripts.')
+    parser.add_argument('--stages', default=','.join(BENCHMARK_STAGES),
+                        help='comma-separated list of stages to benchmark (default: {})'.format(
+                            ','.join(BENCHMARK_STAGES)))
+    parser.add_argument('--M-min', default='0.2,0.32,0.5', help='values of M_min for the sample and survey stages')
+    parser.add_argument('--nlive', default='100,250,500', help='numbers of live points for the fit stage')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative slowdown or memory increase flagged as regression (default: 0.2)')
+    parser.add_argument('--history', default=str(history_file), help='history file')
+    args = parser.parse_args()
+
+    records, regressions = run_benchmarks(stages=args.stages.split(','),
+                                          M_min_values=[float(v) for v in args.M_min.split(',')],
+                                          nlive_values=[int(v) for v in args.nlive.split(',')],
+                                          tolerance=args.tolerance, filename=args.history)
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,232 @@
+"""
+Render the paper figures in parallel, re-rendering only the figures whose inputs changed.
+
+The pipeline artifacts and the heavy modules (matplotlib, seaborn, Bioverse, corner, ...) are loaded once in the
+main process. Every figure script then runs in its own forked process (via `runpy`), which inherits them.
+A figure is skipped if the content hash of its script, the local modules it imports and its input files matches
+the one recorded at its last successful build, and its outputs exist.
+
+Usage:
+    python build_figures.py [--force] [--processes N] [script ...]
+"""
+
+import os
+import ast
+import sys
+import json
+import time
+import runpy
+import hashlib
+import argparse
+import importlib
+import multiprocessing
+from multiprocessing.connection import wait
+import matplotlib
+matplotlib.use('Agg')
+import paths
+import artifacts
+from stagecache import cache_dir
+from sweep import default_processes
+
+manifest_file = cache_dir / 'figures.json'
+
+# figure script: (input files relative to src/data, output files relative to src/tex/figures)
+FIGURES = {
+    'HnullHmo.py': (('pipeline/planets_args.pkl', 'pipeline/sample_columns', 'f_dR_table'),
+                    ('HnullHmo.pdf',)),
+    'cornerplot.py': (('pipeline/sample.pkl', 'pipeline/results_opt.pkl', 'pipeline/params.pkl', 'pipeline/log.pkl',
+                       'pipeline/planets_args.pkl'),
+                      ('corner.pdf',)),
+    'optimistic_RS.py': (('pipeline/data.pkl', 'pipeline/results_opt.pkl', 'pipeline/planets_args.pkl',
+                          'f_dR_table'),
+                         ('optimistic_R-S.pdf',)),
+    'optimistic_RS_binned.py': (('pipeline/data.pkl', 'pipeline/planets_args.pkl', 'pipeline/results_R_binned.pkl',
+                                 'f_dR_table'),
+                                ('optimistic_R-S_binned.pdf',)),
+    'radiusevolution.py': (('pipeline/planets_args.pkl', 'pipeline/sample_columns'),
+                           ('radiuscomparison.pdf', 'radiusevolution.pdf')),
+    'MR_violins.py': (('pipeline/planets_args.pkl', 'bioverse_objects/columnar/optimistic_MR_Wolfgang2016',
+                       'bioverse_objects/columnar/optimistic_MR_earthlike',
+                       'bioverse_objects/columnar/optimistic_H2O-f-grid'),
+                      ('MR-violins.pdf',)),
+    'optimistic_statpwr_H2O-f.py': (('bioverse_objects/columnar/optimistic_H2O-f-grid_G16',),
+                                    ('optimistic_statpwr_H2O-f.pdf',)),
+    'plato_grids.py': (tuple('bioverse_objects/columnar/' + grid for grid in (
+                           'plato_f-grid', 'plato100_f-grid', 'plato40_f-grid', 'plato_rho_f-grid',
+                           'plato_FGK_R', 'plato_FGK_rho', 'plato_M_R', 'plato_M_rho')),
+                       ('plato_fgrid.pdf',)),
+    'plato_Sthresh_grid.py': (('pipeline/planets_args.pkl', 'bioverse_objects/columnar/plato100_f-grid',
+                               'bioverse_objects/columnar/plato_rho_f-grid',
+                               'bioverse_objects/columnar/plato_M_rho_100'),
+                              ('S_thresh_posteriors.pdf',)),
+    'model_pop_comparison.py': (('pipeline/stars_args.pkl', 'pipeline/planets_args.pkl',
+                                 'avg_deltaR_deltaRho.csv'),
+                                ('model_pop_comparison.pdf',)),
+    'plot_luminosity_tracks.py': (tuple('Lum_m{}.txt'.format(m) for m in ('0.1', '0.2', '0.4', '0.6', '0.8',
+                                                                           '1.0', '1.2', '1.4')),
+                                  ('luminosity_tracks.pdf',)),
+}
+
+# imported in the main process, so that the figure processes do not pay for the imports
+PRELOAD_MODULES = ('numpy', 'pandas', 'scipy.interpolate', 'matplotlib.pyplot', 'seaborn', 'corner', 'cmocean',
+                   'bioverse.hypothesis', 'bioverse.analysis', 'bioverse.plots', 'plotstyle', 'utils', 'columnar')
+
+
+def local_modules(script, found=None):
+    """modules in src/scripts imported by a script, directly or through other local modules."""
+    found = set() if found is None else found
+    with open(paths.scripts / script) as f:
+        tree = ast.parse(f.read())
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names = [node.module]
+        else:
+            continue
+        for name in names:
+            module = name.split('.')[0] + '.py'
+            if module not in found and (paths.scripts / module).exists():
+                found.add(module)
+                local_modules(module, found)
+    return found
+
+
+def file_hash(path, file_cache):
+    """sha1 of a file or of all files in a directory; None if missing. Reuses hashes of unchanged files."""
+    if os.path.isdir(path):
+        h = hashlib.sha1()
+        for filename in sorted(os.path.join(root, name) for root, _, files in os.walk(path) for name in files):
+            h.update(os.path.relpath(filename, path).encode())
+            h.update(file_hash(filename, file_cache).encode())
+        return h.hexdigest()
+    if not os.path.exists(path):
+        return None
+
+    stat = os.stat(path)
+    key = str(path)
+    if key in file_cache and file_cache[key][:2] == [stat.st_mtime_ns, stat.st_size]:
+        return file_cache[key][2]
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    file_cache[key] = [stat.st_mtime_ns, stat.st_size, h.hexdigest()]
+    return h.hexdigest()
+
+
+def figure_hash(script, file_cache):
+    """content hash of a figure script, the local modules it imports, the matplotlibrc and its input files."""
+    inputs, _ = FIGURES[script]
+    files = [paths.scripts / module for module in sorted({script} | local_modules(script))]
+    files += [paths.scripts / 'matplotlibrc'] + [paths.data / filename for filename in inputs]
+    h = hashlib.sha1()
+    for filename in files:
+        h.update(os.path.relpath(filename, paths.src).encode())
+        h.update(str(file_hash(filename, file_cache)).encode())
+    return h.hexdigest()
+
+
+def load_manifest(filename=manifest_file):
+    if not os.path.exists(filename):
+        return {'figures': {}, 'files': {}}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, filename=manifest_file):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(str(filename) + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(str(filename) + '.tmp', filename)
+
+
+def preload(scripts):
+    """import the heavy modules and unpickle the pipeline artifacts read by `scripts`."""
+    for module in PRELOAD_MODULES:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            # the figure script reports the missing module itself
+            pass
+    artifacts.preload(sorted({os.path.basename(filename)[:-len('.pkl')]
+                              for script in scripts for filename in FIGURES[script][0]
+                              if filename.startswith('pipeline/') and filename.endswith('.pkl')}))
+
+
+def _render(script):
+    """run a figure script in this (forked) process."""
+    os.chdir(paths.scripts)
+    runpy.run_path(str(paths.scripts / script), run_name='__main__')
+
+
+def build_figures(scripts=None, force=False, processes=None):
+    """Render all figures whose inputs changed since their last build.
+
+    Parameters
+    ----------
+    scripts : iterable of str
+        figure scripts to consider; all scripts in `FIGURES` if None
+    force : bool
+        render the figures even if their inputs did not change
+    processes : int
+        maximum number of figures rendered at the same time. Defaults to the number of available cores.
+
+    Returns
+    -------
+    failed : list of str
+        scripts that raised an error
+    """
+    scripts = list(FIGURES) if scripts is None else list(scripts)
+    manifest = load_manifest()
+    hashes = {script: figure_hash(script, manifest['files']) for script in scripts}
+    outdated = [script for script in scripts
+                if force or manifest['figures'].get(script) != hashes[script]
+                or not all((paths.figures / output).exists() for output in FIGURES[script][1])]
+    print('{} of {} figures to render.'.format(len(outdated), len(scripts)))
+    if not outdated:
+        save_manifest(manifest)
+        return []
+
+    t_start = time.time()
+    preload(outdated)
+    print('Preloaded modules and artifacts in {:.1f} s.'.format(time.time() - t_start))
+
+    # each figure gets a fresh fork of this process, so that scripts cannot affect each other
+    ctx = multiprocessing.get_context('fork')
+    processes = processes or default_processes()
+    pending, running, failed = list(outdated), {}, []
+    while pending or running:
+        while pending and len(running) < processes:
+            script = pending.pop(0)
+            process = ctx.Process(target=_render, args=(script,), name=script)
+            process.start()
+            running[process.sentinel] = (script, process, time.time())
+        for sentinel in wait(list(running)):
+            script, process, t_script = running.pop(sentinel)
+            process.join()
+            if process.exitcode == 0:
+                manifest['figures'][script] = hashes[script]
+                save_manifest(manifest)
+                print('{}: done in {:.1f} s'.format(script, time.time() - t_script))
+            else:
+                failed.append(script)
+                print('{}: FAILED (exit code {})'.format(script, process.exitcode))
+
+    print('Rendered {} figures in {:.1f} s.'.format(len(outdated) - len(failed), time.time() - t_start))
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render the paper figures whose inputs changed.')
+    parser.add_argument('scripts', nargs='*', help='figure scripts to build (default: all)')
+    parser.add_argument('--force', action='store_true', help='render the figures even if nothing changed')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='maximum number of figures rendered in parallel (default: number of cores)')
+    args = parser.parse_args()
+    for script in args.scripts:
+        if script not in FIGURES:
+            parser.error('unknown figure script: {}'.format(script))
+
+    failed = build_figures(args.scripts or None, force=args.force, processes=args.processes)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,428 @@
+"""
+Columnar on-disk format for hypothesis testing grids and synthetic samples.
+
+The grids in `src/data/bioverse_objects` are monolithic pickles holding, among others, the posterior chains of every
+simulation. Here, each array of a grid is stored in its own `.npy` file that can be memory-mapped, and everything
+else (the grid axes, the hypothesis object, ...) in a small pickle. Loading a grid thus only reads the arrays that
+are actually used, e.g. `dlnZ`, and never deserializes the chains unless they are accessed. The grids are converted
+by running this module, which the `columnar_grids` rule of the Snakefile does for every grid a figure depends on.
+
+Likewise, the synthetic sample is stored column by column in a compact form (float32 where the precision allows,
+booleans as bit arrays), so that figure scripts read only the columns and rows they plot. Reproducible subsamples
+of the sample, stratified by transiting and has_magmaocean, are stored alongside as row indices.
+"""
+
+import os
+import sys
+import json
+import pickle
+from collections.abc import Mapping
+from pathlib import Path
+import numpy as np
+import paths
+
+store_dir = paths.data / 'bioverse_objects/columnar'
+sample_dir = paths.data / 'pipeline/sample_columns'
+META_FILE = '_meta.pkl'
+MANIFEST_FILE = 'manifest.json'
+SUBSAMPLES_FILE = 'subsamples.npz'
+STRATA = ('transiting', 'has_magmaocean')
+
+
+def convert_grid(filename, outdir=None):
+    """Convert a pickled results grid to the columnar format.
+
+    Parameters
+    ----------
+    filename : str or Path
+        path to the pickled grid. Relative paths are relative to `src/data/bioverse_objects`.
+    outdir : str or Path
+        output directory. Defaults to `src/data/bioverse_objects/columnar/<name>`.
+
+    Returns
+    -------
+    outdir : Path
+        directory containing the converted grid
+    """
+    filename = paths.data / 'bioverse_objects' / filename
+    outdir = store_dir / filename.stem if outdir is None else Path(outdir)
+    os.makedirs(outdir, exist_ok=True)
+
+    with open(filename, 'rb') as f:
+        results_grid = pickle.load(f)
+
+    meta = {}
+    for key, val in results_grid.items():
+        if (isinstance(val, np.ndarray) and val.dtype.hasobject and val.size
+                and all(v is None or isinstance(v, np.ndarray) for v in val.flat)
+                and any(isinstance(v, np.ndarray) for v in val.flat)):
+            # ragged arrays, e.g. chains of different length: one file per grid cell. Cells without an array
+            # (e.g. the unfinished cells of a sweep, see `sweep.collect_sweep`) get no file and load as None.
+            os.makedirs(outdir / key, exist_ok=True)
+            for idx in np.ndindex(val.shape):
+                if val[idx] is not None:
+                    np.save(outdir / key / _cell_name(idx), val[idx])
+            np.save(outdir / key / 'shape.npy', np.array(val.shape))
+        elif isinstance(val, np.ndarray):
+            np.save(outdir / (key + '.npy'), val, allow_pickle=val.dtype.hasobject)
+        else:
+            meta[key] = val
+
+    # the metadata file is written last and marks a complete conversion
+    with open(outdir / META_FILE, 'wb') as f:
+        pickle.dump(meta, f)
+    return outdir
+
+
+def _cell_name(idx):
+    return 'cell_{}.npy'.format('_'.join(str(i) for i in idx))
+
+
+class LazyChains:
+    """Array-like access to posterior chains that reads only the requested grid cells from disk.
+
+    Supports the indexing semantics of the chains array in a results grid, e.g. `chains[i, j, n]` for the samples
+    of one simulation or `chains[:, :, :, 0]` for one parameter of all simulations.
+
+    Parameters
+    ----------
+    path : Path
+        either a `.npy` file holding a regular chains array, or a directory with one `.npy` file per grid cell
+        (for chains of different length). Cells without a file are missing and returned as None.
+    """
+
+    def __init__(self, path, mmap_mode='r'):
+        self.path = Path(path)
+        self.mmap_mode = mmap_mode
+        if self.path.is_dir():
+            self._array = None
+            self.shape = tuple(np.load(self.path / 'shape.npy'))
+            self.dtype = np.dtype(object)
+        else:
+            try:
+                self._array = np.load(self.path, mmap_mode=mmap_mode)
+            except ValueError:
+                # arrays of Python objects cannot be memory-mapped
+                self._array = np.load(self.path, allow_pickle=True)
+            self.shape = self._array.shape
+            self.dtype = self._array.dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _load_cell(self, idx, sample_item):
+        filename = self.path / _cell_name(idx)
+        if not filename.exists():
+            return None
+        return np.array(np.load(filename, mmap_mode=self.mmap_mode)[sample_item])
+
+    def __getitem__(self, item):
+        if self._array is not None:
+            # copy only the selected slice of the memory-mapped array into memory
+            return np.array(self._array[item])
+
+        # ragged chains: find the grid cells addressed by `item` and load only those
+        grid_item = item if isinstance(item, tuple) else (item,)
+        sample_item = grid_item[self.ndim:]
+        cells = np.arange(int(np.prod(self.shape))).reshape(self.shape)[grid_item[:self.ndim]]
+        if np.ndim(cells) == 0:
+            return self._load_cell(np.unravel_index(cells, self.shape), sample_item)
+        out = np.empty(cells.shape, dtype=object)
+        for idx in np.ndindex(cells.shape):
+            out[idx] = self._load_cell(np.unravel_index(cells[idx], self.shape), sample_item)
+        return out
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[...], dtype=dtype)
+
+
+class ColumnarGrid(Mapping):
+    """Read-only, lazily loaded view of a results grid in columnar format.
+
+    Arrays are memory-mapped on first access. Chains are returned as `LazyChains`, which read only the requested
+    grid cells. Other arrays of Python objects cannot be memory-mapped and are loaded in full.
+    """
+
+    def __init__(self, path, mmap_mode='r'):
+        self.path = Path(path)
+        self.mmap_mode = mmap_mode
+        with open(self.path / META_FILE, 'rb') as f:
+            self._meta = pickle.load(f)
+        self._arrays = sorted(p.stem for p in self.path.glob('*.npy'))
+        self._ragged = sorted(p.name for p in self.path.iterdir() if p.is_dir())
+        self._loaded = {}
+
+    def __getitem__(self, key):
+        if key in self._meta:
+            return self._meta[key]
+        if key not in self._arrays and key not in self._ragged:
+            raise KeyError(key)
+        if key not in self._loaded:
+            filename = self.path / (key + '.npy')
+            if key == 'chains' or key in self._ragged:
+                # chains are accessed cell by cell
+                self._loaded[key] = LazyChains(self.path / key if key in self._ragged else filename,
+                                               mmap_mode=self.mmap_mode)
+                return self._loaded[key]
+            try:
+                self._loaded[key] = np.load(filename, mmap_mode=self.mmap_mode)
+            except ValueError:
+                self._loaded[key] = np.load(filename, allow_pickle=True)
+        return self._loaded[key]
+
+    def __iter__(self):
+        yield from self._meta
+        yield from self._arrays
+        yield from self._ragged
+
+    def __len__(self):
+        return len(self._meta) + len(self._arrays) + len(self._ragged)
+
+    def copy(self):
+        return dict(self)
+
+
+def load_grid(filename, mmap_mode='r'):
+    """Load a results grid from the columnar store.
+
+    The store is built from the pickles by the `columnar_grids` rule of the Snakefile (`python columnar.py`).
+
+    Parameters
+    ----------
+    filename : str
+        file name of the pickled grid in `src/data/bioverse_objects`, e.g. 'plato_f-grid.pkl'
+    mmap_mode : str
+        memory-map mode for `numpy.load`
+
+    Returns
+    -------
+    results_grid : ColumnarGrid
+        dict-like view of the grid
+    """
+    pkl = paths.data / 'bioverse_objects' / filename
+    outdir = store_dir / pkl.stem
+    meta = outdir / META_FILE
+    if not meta.exists():
+        raise FileNotFoundError('{} has not been converted to the columnar format; run '
+                                '`python src/scripts/columnar.py {}` first'.format(filename, pkl.name))
+    if pkl.exists() and pkl.stat().st_mtime > meta.stat().st_mtime:
+        raise RuntimeError('the columnar store of {} is older than the pickle; run '
+                           '`python src/scripts/columnar.py {}` again'.format(filename, pkl.name))
+    return ColumnarGrid(outdir, mmap_mode=mmap_mode)
+
+
+def save_table(table, outdir=sample_dir, rtol=1e-6):
+    """Store a table column by column in a compact form.
+
+    float64 columns are stored as float32 if this changes no value by more than `rtol`, integer columns with the
+    smallest integer type holding their range, and boolean columns as bit arrays. Note that float32 rounding changes
+    a value by at most ~6e-8, so with the default `rtol` every column is downcast unless it holds values outside the
+    normal float32 range (which would overflow or lose precision). Pass a smaller tolerance for the columns that
+    need full precision, e.g. `rtol={'a': 0.}`; these are then kept as float64 unless float32 represents them exactly.
+
+    Parameters
+    ----------
+    table : Bioverse Table or dict of arrays
+        the table to store
+    outdir : str or Path
+        output directory
+    rtol : float or dict
+        maximum relative error tolerated when downcasting floats, either for all columns or per column name
+        (columns that are not in the dict use 1e-6)
+    """
+    outdir = Path(outdir)
+    os.makedirs(outdir, exist_ok=True)
+    manifest = {'length': None, 'columns': {}}
+    for key in table.keys():
+        col = np.asarray(table[key])
+        manifest['length'] = len(col)
+        encoding = 'raw'
+        if col.dtype == bool and col.ndim == 1:
+            encoding = 'bits'
+            stored = np.packbits(col)
+        elif col.dtype.kind == 'f' and col.dtype.itemsize > 4:
+            col_rtol = rtol.get(key, 1e-6) if isinstance(rtol, dict) else rtol
+            with np.errstate(over='ignore', invalid='ignore'):
+                stored = col.astype(np.float32)
+                if not np.allclose(stored, col, rtol=col_rtol, atol=0., equal_nan=True):
+                    stored = col
+        elif col.dtype.kind in 'iu' and len(col):
+            stored = col.astype(np.promote_types(np.min_scalar_type(col.min()), np.min_scalar_type(col.max())))
+        else:
+            stored = col
+        np.save(outdir / (key + '.npy'), stored, allow_pickle=stored.dtype.hasobject)
+        manifest['columns'][key] = {'encoding': encoding, 'dtype': col.dtype.str if not col.dtype.hasobject else 'O'}
+
+    # the manifest is written last and marks a complete table
+    with open(outdir / MANIFEST_FILE, 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def load_table(path=sample_dir, columns=None, rows=None):
+    """Load selected columns and rows of a table stored with `save_table`.
+
+    Parameters
+    ----------
+    path : str or Path
+        directory of the stored table
+    columns : iterable of str
+        columns to load; all if None. Columns that are not in the table are skipped.
+    rows : array_like
+        row indices to load; all if None
+
+    Returns
+    -------
+    df : pd.DataFrame
+        the selected data, with the original dtypes and the row indices as index
+    """
+    import pandas as pd
+    path = Path(path)
+    with open(path / MANIFEST_FILE) as f:
+        manifest = json.load(f)
+    if columns is None:
+        columns = list(manifest['columns'])
+
+    data = {}
+    for key in columns:
+        if key not in manifest['columns']:
+            continue
+        info = manifest['columns'][key]
+        if info['encoding'] == 'bits':
+            col = np.unpackbits(np.load(path / (key + '.npy')), count=manifest['length']).astype(bool)
+        elif info['dtype'] == 'O':
+            col = np.load(path / (key + '.npy'), allow_pickle=True)
+        else:
+            col = np.load(path / (key + '.npy'), mmap_mode='r')
+        if rows is not None:
+            col = col[rows]
+        data[key] = np.asarray(col).astype(info['dtype'] if info['dtype'] != 'O' else object)
+
+    index = np.arange(manifest['length']) if rows is None else np.asarray(rows)
+    return pd.DataFrame(data, index=index)
+
+
+def table_length(path=sample_dir):
+    """number of rows of a table stored with `save_table`."""
+    with open(Path(path) / MANIFEST_FILE) as f:
+        return json.load(f)['length']
+
+
+def load_sample(columns=None, n=None, random_state=None, path=sample_dir):
+    """Load selected columns of (a random subsample of) the synthetic sample.
+
+    Parameters
+    ----------
+    columns : iterable of str
+        columns to load; all if None
+    n : int
+        size of the random subsample; the full sample if None
+    random_state : int
+        seed of the subsample. Draws the same rows as `pandas.DataFrame.sample(n, random_state=random_state)`.
+
+    Returns
+    -------
+    df : pd.DataFrame
+        the selected data
+    """
+    rows = None
+    if n is not None:
+        length = table_length(path)
+        rows = np.random.RandomState(random_state).choice(length, size=min(n, length), replace=False)
+    return load_table(path, columns=columns, rows=rows)
+
+
+def stratified_indices(table, n, strata=STRATA, mask=None, seed=42):
+    """Draw a random subsample of rows with the same composition as the table.
+
+    Every stratum (combination of the boolean columns in `strata`) contributes in proportion to its size, with
+    the remainders going to the strata with the largest fractional quotas.
+
+    Parameters
+    ----------
+    table : Bioverse Table, pd.DataFrame or dict of arrays
+        the table to subsample
+    n : int
+        size of the subsample
+    strata : iterable of str
+        boolean columns defining the strata
+    mask : array_like of bool
+        if given, draw only from the rows where `mask` is true
+    seed : int
+        seed of the random draw
+
+    Returns
+    -------
+    rows : np.ndarray
+        sorted row indices of the subsample
+    """
+    candidates = np.arange(len(table[strata[0]])) if mask is None else np.flatnonzero(mask)
+    if n >= len(candidates):
+        return candidates
+
+    codes = np.zeros(len(candidates), dtype=int)
+    for i, key in enumerate(strata):
+        codes += np.asarray(table[key], dtype=bool)[candidates] << i
+    counts = np.bincount(codes, minlength=2 ** len(strata))
+    quotas = counts * n / len(candidates)
+    sizes = np.floor(quotas).astype(int)
+    sizes[np.argsort(sizes - quotas, kind='stable')[:n - sizes.sum()]] += 1
+
+    rng = np.random.RandomState(seed)
+    rows = [rng.choice(candidates[codes == code], size=size, replace=False) for code, size in enumerate(sizes)
+            if size > 0]
+    return np.sort(np.concatenate(rows))
+
+
+def save_subsamples(table, subsamples, outdir=sample_dir, seed=42):
+    """Store the row indices of stratified subsamples of a table.
+
+    Parameters
+    ----------
+    table : Bioverse Table or dict of arrays
+        the full table
+    subsamples : dict
+        name: (n, column) of each subsample. If column is not None, the subsample is drawn only from the rows
+        where this boolean column is true.
+    outdir : str or Path
+        directory of the stored table, see `save_table`
+    seed : int
+        seed of the random draws
+    """
+    indices = {}
+    for name, (n, column) in subsamples.items():
+        mask = None if column is None else np.asarray(table[column], dtype=bool)
+        indices[name] = stratified_indices(table, n, mask=mask, seed=seed)
+    os.makedirs(outdir, exist_ok=True)
+    np.savez(Path(outdir) / SUBSAMPLES_FILE, **indices)
+
+
+def load_subsample(name, columns=None, path=sample_dir):
+    """Load selected columns of a stratified subsample stored with `save_subsamples`.
+
+    Parameters
+    ----------
+    name : str
+        name of the subsample, e.g. 'all_15000'
+    columns : iterable of str
+        columns to load; all if None
+
+    Returns
+    -------
+    df : pd.DataFrame
+        the selected data, indexed by the row indices in the full sample
+    """
+    with np.load(Path(path) / SUBSAMPLES_FILE) as subsamples:
+        rows = subsamples[name]
+    return load_table(path, columns=columns, rows=rows)
+
+
+if __name__ == '__main__':
+    # convert the given pickled grids, or all of them
+    pkls = [Path(arg) for arg in sys.argv[1:]] or sorted((paths.data / 'bioverse_objects').glob('*.pkl'))
+    for pkl in pkls:
+        print('converting {}'.format(pkl.name))
+        convert_grid(pkl.name)
@@ -1,8 +1,8 @@
 """Show corner plot of parameter inference example"""
 
-import pickle
 import corner
 import paths
+import artifacts
 import numpy as np
 import pandas as pd
 from bioverse.constants import CONST
@@ -39,16 +39,11 @@ def cornerplot(results, params, log, planets_args, parameter_of_interest, sample
     return fig
 
 
-with open(paths.data / 'pipeline/sample.pkl', 'rb') as f:
-    sample = pickle.load(f)
-with open(paths.data / 'pipeline/results_opt.pkl', 'rb') as f:
-    results_opt = pickle.load(f)
-with open(paths.data / 'pipeline/params.pkl', 'rb') as f:
-    params = pickle.load(f)
-with open(paths.data / 'pipeline/log.pkl', 'rb') as f:
-    log = pickle.load(f)
-with open(paths.data / 'pipeline/planets_args.pkl', 'rb') as f:
-    planets_args = pickle.load(f)
+sample = artifacts.load('sample')
+results_opt = artifacts.load('results_opt')
+params = artifacts.load('params')
+log = artifacts.load('log')
+planets_args = artifacts.load('planets_args')
 
 fig = cornerplot(results_opt, params, log, planets_args, parameter_of_interest='R', sample=sample)
 
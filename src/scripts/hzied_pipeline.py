@@ -9,13 +9,17 @@ import paths
 from utils import *
 import pickle
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from warnings import warn
 import pandas as pd
-import seaborn as sns
 
 from scipy.interpolate import interp1d
+from stagecache import stage_key, cached_stage, seed_stage
+from columnar import save_table, save_subsamples
 
 # Import the Generator class
 from bioverse.generator import Generator
+from bioverse.classes import Table
 from bioverse.survey import TransitSurvey
 from bioverse.constants import CONST, DATA_DIR
 from bioverse.hypothesis import Hypothesis, magma_ocean_hypo, magma_ocean_f0, get_avg_deltaR_deltaRho
@@ -23,10 +27,6 @@ from bioverse.hypothesis import Hypothesis, magma_ocean_hypo, magma_ocean_f0, ge
 # Sample generation
 ## Generate stars and planets, inject magma oceans
 
-# Parameters of the analysis
-# parameter_of_interest = 'rho'
-parameter_of_interest = 'R'
-
 def get_generator_args():
     """ define generator parameters"""
     # Parameters for star generation
@@ -64,86 +64,397 @@ def get_generator_args():
     return stars_args, planets_args
 
 
-def generate_generator(stars_only=False, **kwargs):
-    stars_args, planets_args = get_generator_args()
-    g_args = stars_args | planets_args
-    for key, value in kwargs.items():
-        g_args[key] = value
-    g_transit = Generator(label=None)
-    g_transit.insert_step('read_stars_Gaia')
-    if not stars_only:
-        g_transit.insert_step('create_planets_bergsten')
-        g_transit.insert_step('assign_orbital_elements')
-        g_transit.insert_step('impact_parameter')
-        g_transit.insert_step('assign_mass')
-        g_transit.insert_step('effective_values')
-        g_transit.insert_step('magma_ocean')  # here we inject the magma oceans
-        g_transit.insert_step('compute_transit_params')
-        g_transit.insert_step('apply_bias')
-    [g_transit.set_arg(key, val) for key, val in g_args.items()]
-    return g_transit
-
-
-def generate_sample():
-    g_transit = Generator(label=None)
-    g_transit.insert_step('read_stars_Gaia')
+# Generator steps for star and planet generation, in the order in which they are run
+STAR_STEPS = ('read_stars_Gaia',)
+PLANET_STEPS = ('create_planets_bergsten',
+                'assign_orbital_elements',
+                'impact_parameter',
+                'assign_mass',
+                'effective_values',
+                'magma_ocean',  # here we inject the magma oceans
+                'compute_transit_params',
+                'apply_bias')
+
+# index of the magma_ocean step; the steps before it depend neither on wrr nor on f_rgh
+MAGMA_OCEAN_STEP = len(STAR_STEPS) + PLANET_STEPS.index('magma_ocean')
+
+# cuts of `apply_bias` that can be applied early when pruning, see `run_steps`.
+# step: (column, lower bound argument, upper bound argument), applied right after the step
+PRUNING_CUTS = {'assign_mass': ('M', 'M_min', 'M_max'),
+                'effective_values': ('S_abs', 'S_min', 'S_max')}
+
+# subsamples of the population for the figures, name: (size, boolean column to draw from)
+SUBSAMPLES = {'all_15000': (15000, None),
+              'all_3000': (3000, None)}
+
+# evidence difference above which we consider the magma ocean hypothesis detected
+DLNZ_THRESHOLD = 3.
+
+# create a transit survey (telescope parameters don't really matter here)
+SURVEY_ARGS = {'diameter': 8.5, 't_max': 3652.5, 't_slew': 0.1, 'N_obs_max': 1000}
+
+# measurements our survey conducts
+MEASUREMENT_KEYS = ('L_st', 'R_st', 'M_st', 'T_eff_st', 'd', 'age', 'depth', 'R',
+                    'T_dur', 'P', 'a', 'a_eff', 'S', 'S_abs',
+                    'M', 'rho')
+
+# Optimistic survey: choose optimistic values
+PRECISION = {'T_eff_st': 25.,
+             'R_st': '1%',
+             'depth': '1%',
+             'R': '2%',
+             'M_st': '1%',
+             'age': '30%',
+             'P': 0.000001,
+             'S': '5%',
+             'S_abs': '5%',
+             'M': '5%',
+             'rho': '7%'}
+
+
+def generator_spec(stars_only=False, **kwargs):
+    """Serializable description of the generator: its step names and arguments. kwargs override the arguments."""
     stars_args, planets_args = get_generator_args()
+    steps = STAR_STEPS if stars_only else STAR_STEPS + PLANET_STEPS
+    return {'steps': list(steps), 'args': stars_args | planets_args | kwargs}
+
+
+def survey_spec():
+    """Serializable description of the survey: its parameters and measurements with their precisions."""
+    margs = {'precision': PRECISION}
+    measurements = {mkey: {key: vals[mkey] for key, vals in margs.items() if mkey in vals}
+                    for mkey in MEASUREMENT_KEYS}
+    return {'survey_args': SURVEY_ARGS, 'measurements': measurements}
+
+
+# Generators and surveys built in this process, by the hash of their spec
+_built = {}
+
+
+def build_generator(spec):
+    """Build a generator from its spec, see `generator_spec`.
+
+    The generator is built once per process and spec; later calls return the same object, so do not modify it.
+    """
+    key = ('generator', stage_key(spec))
+    if key not in _built:
+        g_transit = Generator(label=None)
+        for step in spec['steps']:
+            g_transit.insert_step(step)
+        [g_transit.set_arg(key, val) for key, val in spec['args'].items()]
+        _built[key] = g_transit
+    return _built[key]
+
+
+def build_survey(spec):
+    """Build a transit survey from its spec, see `survey_spec`.
+
+    The survey is built once per process and spec; later calls return the same object, so do not modify it.
+    """
+    key = ('survey', stage_key(spec))
+    if key not in _built:
+        survey = TransitSurvey(**spec['survey_args'])
+        for mkey, kwargs in spec['measurements'].items():
+            survey.add_measurement(mkey, **kwargs)
+        _built[key] = survey
+    return _built[key]
+
+
+def generate_generator(stars_only=False, **kwargs):
+    return build_generator(generator_spec(stars_only, **kwargs))
+
+
+def run_steps(g_transit, d, idx_start=0, idx_stop=None, prune=False, **kwargs):
+    """Run a subset of the generator steps on an existing table.
+
+    Parameters
+    ----------
+    g_transit : Bioverse Generator
+        generator whose steps should be run, built from `STAR_STEPS` and `PLANET_STEPS`
+    d : Table
+        input table (an empty Table for the first step)
+    idx_start, idx_stop : int
+        indices of the first and last (exclusive) step to run
+    prune : bool
+        drop planets as soon as they fail a cut of `apply_bias` (see `PRUNING_CUTS`), so that the later steps
+        only run on the survivors. The cuts are inclusive, so `apply_bias` still makes the final selection.
+        Since the later steps then draw fewer random numbers, the sample differs from an unpruned run with the
+        same seed (but follows the same distribution).
+    **kwargs
+        override the generator arguments
+
+    Returns
+    -------
+    d : Table
+        the output of the last step
+    """
+    step_names = STAR_STEPS + PLANET_STEPS
+    idx_stop = len(g_transit.steps) if idx_stop is None else idx_stop
+    for idx in range(idx_start, idx_stop):
+        d = g_transit.steps[idx].run(d, **kwargs)
+        if prune and step_names[idx] in PRUNING_CUTS:
+            d = prune_table(g_transit, d, *PRUNING_CUTS[step_names[idx]], **kwargs)
+    return d
+
+
+def get_arg(g_transit, key, **kwargs):
+    """value of a generator argument, unless overridden in kwargs. None if no step uses it."""
+    if key in kwargs:
+        return kwargs[key]
+    for step in g_transit.steps:
+        if key in step.args:
+            return step.args[key]
+    return None
+
+
+def prune_table(g_transit, d, column, min_arg, max_arg, **kwargs):
+    """Keep only the rows with `column` within the (inclusive) bounds given by the generator arguments
+    `min_arg` and `max_arg`. Tables without the column are returned unchanged."""
+    if column not in d.keys():
+        return d
+    keep = np.ones(len(d[column]), dtype=bool)
+    lower, upper = get_arg(g_transit, min_arg, **kwargs), get_arg(g_transit, max_arg, **kwargs)
+    if lower is not None:
+        keep &= d[column] >= lower
+    if upper is not None:
+        keep &= d[column] <= upper
+    return d if keep.all() else subset_table(d, keep)
+
+
+def generate_stars(g_transit):
+    """Run the star generation steps.
+
+    Returns
+    -------
+    stars : Table
+        the star catalog
+    rng_state : tuple
+        state of the random number generator after star generation, so that a cached star
+        catalog yields the same planets as an uncached run.
+    """
+    stars = run_steps(g_transit, Table(), idx_stop=len(STAR_STEPS))
+    return stars, np.random.get_state()
+
+
+def subset_table(d, idx):
+    """rows `idx` (index array, mask or slice) of a Table."""
+    subset = Table()
+    for key in d.keys():
+        subset[key] = d[key][idx]
+    return subset
+
+
+def concatenate_tables(tables):
+    """concatenate Tables with the same columns."""
+    d = Table()
+    if not tables:
+        return d
+    for key in tables[0].keys():
+        d[key] = np.concatenate([t[key] for t in tables])
+    return d
+
+
+def generate_planets(g_transit, stars, rng_state, chunk_size=None, prune=False):
+    """Run the planet generation steps on a star catalog.
+
+    Parameters
+    ----------
+    g_transit : Bioverse Generator
+        the generator
+    stars : Table
+        star catalog, see `generate_stars`
+    rng_state : tuple
+        state of the random number generator after star generation
+    chunk_size : int
+        if given, stream the stars in batches of this size through the planet steps (including `apply_bias`)
+        and keep only the surviving planets of each batch. Peak memory then scales with the biased sample
+        instead of the planet population of the full catalog.
+    prune : bool
+        drop planets outside the mass and instellation cuts as soon as these are known, see `run_steps`
+
+    Returns
+    -------
+    sample : Table
+        the synthetic planets
+    """
+    np.random.set_state(rng_state)
+    if chunk_size is None or len(stars) == 0:
+        return run_steps(g_transit, stars, idx_start=len(STAR_STEPS), prune=prune)
+
+    chunks = []
+    for start in range(0, len(stars), chunk_size):
+        chunk = subset_table(stars, slice(start, start + chunk_size))
+        chunks.append(run_steps(g_transit, chunk, idx_start=len(STAR_STEPS), prune=prune))
+    sample = concatenate_tables(chunks)
+
+    # the planet IDs are numbered per chunk; make them unique across the sample
+    if 'planetID' in sample:
+        sample['planetID'] = np.arange(len(sample))
+    return sample
+
+
+def tile_table(d, N, column='realisation'):
+    """N stacked copies of a Table, with the index of the copy in `column`."""
+    tiled = Table()
+    for key in d.keys():
+        tiled[key] = np.concatenate([d[key]] * N)
+    tiled[column] = np.repeat(np.arange(N), len(d))
+    return tiled
+
+
+def generate_realisations(g_transit, stars, N, seed=42, **kwargs):
+    """Generate N independent planet populations around the same stars in one pass of the planet steps.
+
+    The star catalog is tiled N times and every row is tagged with its realisation id in the column
+    'realisation', which the planet steps pass on to the planets.
+
+    Bioverse draws from numpy's global random state, so the realisations cannot get RNG streams of their own
+    within one vectorized pass. Instead, the global state is seeded once per batch from a stream spawned by
+    `np.random.SeedSequence`; the realisations consume disjoint draws of it and are thus independent.
+
+    Parameters
+    ----------
+    g_transit : Bioverse Generator
+        the generator
+    stars : Table
+        star catalog, see `generate_stars`
+    N : int
+        number of realisations
+    seed : int or np.random.SeedSequence
+        seed of the batch, e.g. one of `np.random.SeedSequence(42).spawn(n)`
+    **kwargs
+        override the generator arguments
+
+    Returns
+    -------
+    sample : Table
+        the planets of all realisations, see `split_realisations`
+    """
+    seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    np.random.seed(seed.generate_state(1)[0])
+    sample = run_steps(g_transit, tile_table(stars, N), idx_start=len(STAR_STEPS), **kwargs)
+    if 'realisation' not in sample:
+        raise ValueError("The planet steps did not pass on the 'realisation' column of the stars.")
+    return sample
+
+
+def split_realisations(sample, N=None):
+    """Split the output of `generate_realisations` into one Table per realisation.
+
+    Parameters
+    ----------
+    sample : Table
+        planets of all realisations
+    N : int
+        number of realisations. Defaults to the highest realisation id + 1.
+
+    Returns
+    -------
+    samples : list of Table
+        the planets of each realisation (possibly empty), in the order of their ids
+    """
+    realisation = sample['realisation']
+    N = realisation.max() + 1 if N is None else N
+    order = np.argsort(realisation, kind='stable')
+    bounds = np.searchsorted(realisation[order], np.arange(N + 1))
+    return [subset_table(sample, order[start:stop]) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def copy_table(d):
+    """copy of a Table that shares no arrays with the original."""
+    copy = Table()
+    for key in d.keys():
+        copy[key] = np.array(d[key], copy=True)
+    return copy
+
 
-    g_transit.insert_step('create_planets_bergsten')
-    g_transit.insert_step('assign_orbital_elements')
-    g_transit.insert_step('impact_parameter')
-    g_transit.insert_step('assign_mass')
-    g_transit.insert_step('effective_values')
-    g_transit.insert_step('magma_ocean')  # here we inject the magma oceans
-    g_transit.insert_step('compute_transit_params')
-    g_transit.insert_step('apply_bias')
+def upstream_args(g_transit, idx_stop=MAGMA_OCEAN_STEP):
+    """names of the generator arguments used by the steps before `idx_stop`."""
+    return set().union(*(step.args for step in g_transit.steps[:idx_stop]))
 
-    # provide generator arguments chosen above
-    [g_transit.set_arg(key, val) for key, val in stars_args.items()]
-    [g_transit.set_arg(key, val) for key, val in planets_args.items()]
 
-    sample = g_transit.generate()
+def snapshot_population(g_transit, stars, seed=42, **kwargs):
+    """Run the planet steps up to, but excluding, `magma_ocean`.
+
+    The snapshot (orbits, masses, transit geometry, ...) does not depend on wrr or f_rgh, so a grid over them
+    can replay only the remaining steps for each cell, see `replay_population`.
+
+    Parameters
+    ----------
+    g_transit : Bioverse Generator
+        the generator
+    stars : Table
+        star catalog, see `generate_stars`
+    seed : int or np.random.SeedSequence
+        seed of the snapshot
+    **kwargs
+        override the generator arguments
+
+    Returns
+    -------
+    snapshot : Table
+        the planet population before injecting magma oceans
+    """
+    seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    np.random.seed(seed.generate_state(1)[0])
+    return run_steps(g_transit, stars, idx_start=len(STAR_STEPS), idx_stop=MAGMA_OCEAN_STEP, **kwargs)
+
+
+def replay_population(g_transit, snapshot, seed=None, **kwargs):
+    """Run `magma_ocean`, `compute_transit_params` and `apply_bias` on a copy of a snapshot.
+
+    Parameters
+    ----------
+    g_transit : Bioverse Generator
+        the generator
+    snapshot : Table
+        population before `magma_ocean`, see `snapshot_population`. It is not modified.
+    seed : int
+        if given, seed numpy's global random state before replaying the steps
+    **kwargs
+        override the generator arguments, e.g. wrr and f_rgh
+
+    Returns
+    -------
+    sample : Table
+        the synthetic planets
+    """
+    if seed is not None:
+        np.random.seed(seed)
+    return run_steps(g_transit, copy_table(snapshot), idx_start=MAGMA_OCEAN_STEP, **kwargs)
+
+
+def generate_sample(chunk_size=None, prune=False, **kwargs):
+    # provide generator arguments chosen above; kwargs override them
+    g_transit = generate_generator(**kwargs)
+    stars, rng_state = generate_stars(g_transit)
+    sample = generate_planets(g_transit, stars, rng_state, chunk_size=chunk_size, prune=prune)
     # print('Total number of planets: {}'.format(len(sample)))
     return sample, g_transit
 
 
-def survey_simulation():
-    """Simulate an ambitious survey with optimistic parameters."""
-    # create a transit survey (telescope parameters don't really matter here)
-    survey = TransitSurvey(diameter=8.5, t_max=3652.5, t_slew=0.1, N_obs_max=1000)
-
-    # Let's add some measurements our survey conducts.
-    margs = {}
-    mkeys = ['L_st', 'R_st', 'M_st', 'T_eff_st', 'd', 'age', 'depth', 'R',
-             'T_dur', 'P', 'a', 'a_eff', 'S', 'S_abs',
-             'M', 'rho']
-
-    # Optimistic survey: choose optimistic values
-    margs['precision'] = {'T_eff_st': 25.,
-                          'R_st': '1%',
-                          'depth': '1%',
-                          'R': '2%',
-                          'M_st': '1%',
-                          'age': '30%',
-                          'P': 0.000001,
-                          'S': '5%',
-                          'S_abs': '5%',
-                          'M': '5%',
-                          'rho': '7%'}
-
-    # Add the measurements to the survey
-    for mkey in mkeys:
-        kwargs = {}
-        for key, vals in margs.items():
-            if mkey in vals:
-                kwargs[key] = vals[mkey]
-        survey.add_measurement(mkey, **kwargs)
+def survey_simulation(sample):
+    """Simulate an ambitious survey with optimistic parameters.
+
+    Parameters
+    ----------
+    sample : Table
+        Table containing the synthetic sample
+
+    Returns
+    -------
+    detected_opt : Table
+        detectable planets
+    data : Table
+        simulated measurements of the detectable planets
+    survey : TransitSurvey
+        the simulated survey
+    """
+    # survey with the measurements and precisions defined above
+    survey = build_survey(survey_spec())
 
     # which planets are detectable?
     detected_opt = survey.compute_yield(sample)
-    N = len(detected_opt)
-    # save_var_latex('N_optimistic', '{:.0f}'.format(N))
-    save_var_latex('N_optimistic', '500') # round that to avoid confusion
 
     # simulate observations, obtain dataset
     data = survey.observe(detected_opt, demographics=True)
@@ -151,9 +462,11 @@ def survey_simulation():
 
 
 def hypotest(data, parameter_of_interest, params, log, bounds, bounds_null, features=('a_eff',), binned=False,
-             nburn=100, nlive=500):
+             nburn=100, nlive=500, planets_args=None, adaptive=False, nlive_min=50, dlnZ_tol=0.5):
     """perform hypothesis test.
 
+    The function does not depend on any global state, so that independent tests can run concurrently.
+
     Parameters
     ----------
     data : Table
@@ -165,8 +478,19 @@ def hypotest(data, parameter_of_interest, params, log, bounds, bounds_null, feat
     nburn : int
         length of burn-in phase in the nested sampling
     nlive : int
-        number of live points for the nested sampling
+        number of live points for the nested sampling (the maximum number if `adaptive`)
+    planets_args : dict
+        arguments for planet sample creation. Defaults to those of `get_generator_args`.
+    adaptive : bool
+        if true, start with `nlive_min` live points and increase them only while the uncertainty of dlnZ is
+        above `dlnZ_tol` and the verdict at the detection threshold is not yet certain (see `adaptive_fit`).
+    nlive_min : int
+        initial number of live points in adaptive mode
+    dlnZ_tol : float
+        target uncertainty of dlnZ in adaptive mode
     """
+    if planets_args is None:
+        planets_args = get_generator_args()[1]
 
     if binned:
         labels = (parameter_of_interest + '_mean_binned',)
@@ -174,12 +498,7 @@ def hypotest(data, parameter_of_interest, params, log, bounds, bounds_null, feat
         labels = (parameter_of_interest + '_mean',)
 
         # interpolate average delta R/delta rho
-    avg_deltaR_deltaRho = get_avg_deltaR_deltaRho()
-    select_mechanisms = (avg_deltaR_deltaRho.gh_increase == planets_args['gh_increase']) & (
-            avg_deltaR_deltaRho.water_incorp == planets_args['water_incorp'])
-    f_dR = scipy.interpolate.interp1d(avg_deltaR_deltaRho[select_mechanisms].wrr,
-                                      avg_deltaR_deltaRho[select_mechanisms]['delta_' + parameter_of_interest],
-                                      fill_value='extrapolate')
+    f_dR = get_f_dR(planets_args['gh_increase'], planets_args['water_incorp'], parameter_of_interest)
 
 
 
@@ -207,7 +526,16 @@ def hypotest(data, parameter_of_interest, params, log, bounds, bounds_null, feat
     # perform hypothesis tests
 
     # Sample the posterior distribution of h(theta | x, y) using a simulated data set, and compare to the null hypothesis via a model comparison metric.
-    results = h_magmaocean.fit(data, return_chains=True, nburn=nburn, nlive=nlive, sampler_results=True)
+    if adaptive:
+        results = adaptive_fit(h_magmaocean, data, nlive_min=nlive_min, nlive_max=nlive, dlnZ_tol=dlnZ_tol,
+                               threshold=DLNZ_THRESHOLD, nburn=nburn)
+        print('Adaptive fit with nlive = {}: {} likelihood calls, {:.0%} of a fit with nlive = {}'.format(
+            results['nlive'], results['ncall_total'], results['ncall_total'] / results['ncall_fixed'], nlive))
+        if not results['converged']:
+            warn('adaptive fit did not converge: dlnZ = {:.1f} +- {:.2f} with nlive = {}'.format(
+                results['dlnZ'], results['dlnZ_err'], results['nlive']))
+    else:
+        results = h_magmaocean.fit(data, return_chains=True, nburn=nburn, nlive=nlive, sampler_results=True)
     # results_opt = h_magmaocean.fit(data, return_chains=True, nburn=500, nsteps=5000, method='emcee')
 
     print("The evidence in favor of the hypothesis is: dlnZ = {:.1f} (corresponds to p = {:.3f})".format(
@@ -215,18 +543,12 @@ def hypotest(data, parameter_of_interest, params, log, bounds, bounds_null, feat
 
     return results, h_magmaocean
 
-def hypothesis_tests(parameter_of_interest='R'):
-    """define the hypothesis, and perform hypothesis tests.
-
-    Sample the posterior; Calculate the Bayesian evidence supporting h_magmaocean in favor of h_null from our simulated dataset.
-    The parameter space is complex, we need to use nested sampling (not MCMC).
-    """
+def get_hypothesis_args(parameter_of_interest='R'):
+    """define the parameters, priors and nested sampling settings of the hypothesis tests."""
     params = ('S_thresh', 'wrr', 'f_rgh', 'avg')
     features = ('a_eff',)
-    labels = (parameter_of_interest + '_mean',)
     log = (False, True, False, False)
 
-
     # define PRIORS for the parameters in theta uniform for 'S_thresh', log-uniform for 'wrr', uniform for 'f_rgh', 'R_avg')
     bounds_R = np.array([[10., 1000.0], [1e-5, 0.1], [0.0, 1.0], [.1, 15.]])
     bounds_rho = np.array([[10., 1000.0], [1e-5, 0.1], [0.0, 1.0], [1., 6.]])
@@ -237,48 +559,292 @@ def hypothesis_tests(parameter_of_interest='R'):
 
     bounds_null = np.array([bounds[-1]])  # prior bounds for null hypothesis
 
-    results_opt, h_magmaocean = hypotest(data, parameter_of_interest, params=params, log=log, bounds=bounds,
-                                         bounds_null=bounds_null, features=features, binned=False)
-    return params, features, log, results_opt, h_magmaocean
+    hypothesis_args = {
+        'params': params,
+        'features': features,
+        'log': log,
+        'bounds': bounds,
+        'bounds_null': bounds_null,
+        'binned': False,
+        'nburn': 100,
+        'nlive': 500
+    }
+    return hypothesis_args
+
+
+def hypothesis_tests(data, planets_args, parameter_of_interest='R', binned=False):
+    """define the hypothesis, and perform hypothesis tests.
+
+    Sample the posterior; Calculate the Bayesian evidence supporting h_magmaocean in favor of h_null from our simulated dataset.
+    The parameter space is complex, we need to use nested sampling (not MCMC).
+
+    Parameters
+    ----------
+    data : Table
+        simulated measurements, see `survey_simulation`
+    planets_args : dict
+        arguments for planet sample creation
+    parameter_of_interest : str
+        Parameter of interest, 'R' or 'rho'
+    binned : bool
+        if true, use the binned average radius/density; otherwise use a rolling mean.
+    """
+    hypothesis_args = get_hypothesis_args(parameter_of_interest)
+    hypothesis_args['binned'] = binned
+    results_opt, h_magmaocean = hypotest(data, parameter_of_interest, planets_args=planets_args, **hypothesis_args)
+    return hypothesis_args['params'], hypothesis_args['features'], hypothesis_args['log'], results_opt, h_magmaocean
+
+
+avg_deltaR_deltaRho_file = paths.data / 'avg_deltaR_deltaRho.csv'
+avg_deltaR_deltaRho_rows = paths.data / 'avg_deltaR_deltaRho_rows'
+MECHANISMS = ((True, True), (True, False), (False, True), (False, False))  # (gh_increase, water_incorp)
+
 
+def _rows_key(stars_args, planets_args, transiting_only):
+    return stage_key(stars_args, planets_args, transiting_only)
 
 
+def _row_file(key, wrr, gh_increase, water_incorp):
+    # rows live in one directory per set of generator arguments, so that changed arguments never reuse stale rows
+    return avg_deltaR_deltaRho_rows / key / 'wrr{:g}_gh{:d}_wi{:d}.csv'.format(wrr, gh_increase, water_incorp)
 
-stars_args, planets_args = get_generator_args()
 
-# Make sure pipeline directory exists
-filename = paths.data / 'pipeline/planets_args.pkl'
-os.makedirs(os.path.dirname(filename), exist_ok=True)
-with open(paths.data / 'pipeline/planets_args.pkl', 'wb') as file:
-    pickle.dump(planets_args, file)
-with open(paths.data / 'pipeline/stars_args.pkl', 'wb') as file:
-    pickle.dump(stars_args, file)
+def _table_key(filename):
+    """key of the generator arguments recorded in the header of an avg_deltaR_deltaRho table, if any."""
+    with open(filename) as f:
+        for line in f:
+            if not line.startswith('#'):
+                break
+            if line.startswith('# stage_key:'):
+                return line.split(':', 1)[1].strip()
+    return None
 
 
-sample, g_transit = generate_sample()
-with open(paths.data / 'pipeline/sample.pkl', 'wb') as file:
-    pickle.dump(sample, file)
-with open(paths.data / 'pipeline/g_transit.pkl', 'wb') as file:
-    pickle.dump(g_transit, file)
+def compute_deltaR_deltaRho_row(wrr, gh_increase, water_incorp, stars_args, planets_args, transiting_only=True):
+    """Compute the average radius and density difference of runaway greenhouse planets for one water mass fraction
+    and combination of mechanisms, and checkpoint the result to its own file.
 
+    All planets in the runaway greenhouse regime are given a magma ocean (f_rgh = 1).
 
-detected_opt, data, survey = survey_simulation()
-with open(paths.data / 'pipeline/data.pkl', 'wb') as file:
-    pickle.dump(data, file)
-with open(paths.data / 'pipeline/survey.pkl', 'wb') as file:
-    pickle.dump(survey, file)
+    Returns
+    -------
+    row : pd.DataFrame
+        single row with columns wrr, gh_increase, water_incorp, delta_R, delta_rho
+    """
+    g_args = stars_args | planets_args | {'wrr': wrr, 'gh_increase': gh_increase, 'water_incorp': water_incorp,
+                                          'f_rgh': 1.}
+    sample, g_transit = generate_sample(**g_args)
+    dd = sample.to_pandas()
+    if transiting_only:
+        dd = dd[dd.transiting]
+    mo = dd[dd.has_magmaocean]
+    row = pd.DataFrame({'wrr': [wrr], 'gh_increase': [gh_increase], 'water_incorp': [water_incorp],
+                        'delta_R': [np.average(mo.R - mo.R_orig)],
+                        'delta_rho': [np.average(mo.rho - CONST['rho_Earth'] * mo.M / mo.R_orig ** 3)]})
+
+    filename = _row_file(_rows_key(stars_args, planets_args, transiting_only), wrr, gh_increase, water_incorp)
+    row.to_csv(filename.with_suffix('.tmp'), index=False)
+    os.replace(filename.with_suffix('.tmp'), filename)
+    return row
+
+
+def build_avg_deltaR_deltaRho(stars_args, planets_args, wrrs, mechanisms=MECHANISMS, transiting_only=True,
+                              processes=None):
+    """Build the table of average radius/density differences incrementally.
+
+    Every (wrr, gh_increase, water_incorp) row is computed in its own process and checkpointed under a hash of the
+    generator arguments, so that only rows that are not on disk yet are computed (e.g. after adding a new water mass
+    fraction). Rows of an existing avg_deltaR_deltaRho.csv are reused if its header records the same hash. The
+    assembled table is written to src/data/avg_deltaR_deltaRho.csv.
+
+    Parameters
+    ----------
+    stars_args, planets_args : dict
+        generator arguments
+    wrrs : iterable of float
+        water mass fractions
+    mechanisms : iterable of tuple
+        combinations of (gh_increase, water_incorp)
+    processes : int
+        number of worker processes. Defaults to the number of available cores.
+
+    Returns
+    -------
+    avg_deltaR_deltaRho : pd.DataFrame
+        the table
+    """
+    from sweep import default_processes
+    key = _rows_key(stars_args, planets_args, transiting_only)
+    os.makedirs(avg_deltaR_deltaRho_rows / key, exist_ok=True)
+    rows = [(float(wrr), bool(gh), bool(wi)) for wrr in wrrs for gh, wi in mechanisms]
+
+    # reuse the rows of a previously computed table with the same generator arguments
+    if avg_deltaR_deltaRho_file.exists() and _table_key(avg_deltaR_deltaRho_file) == key:
+        previous = pd.read_csv(avg_deltaR_deltaRho_file, comment='#')
+        for wrr, gh, wi in rows:
+            match = previous[np.isclose(previous.wrr, wrr) & (previous.gh_increase == gh) & (previous.water_incorp == wi)]
+            if len(match) and not _row_file(key, wrr, gh, wi).exists():
+                match.iloc[:1].to_csv(_row_file(key, wrr, gh, wi), index=False)
+
+    missing = [row for row in rows if not _row_file(key, *row).exists()]
+    if missing:
+        print('computing {} of {} rows of the radius/density difference table'.format(len(missing), len(rows)))
+        with ProcessPoolExecutor(max_workers=min(processes or default_processes(), len(missing))) as executor:
+            futures = [executor.submit(compute_deltaR_deltaRho_row, *row, stars_args, planets_args, transiting_only)
+                       for row in missing]
+            [future.result() for future in futures]
+
+    avg_deltaR_deltaRho = pd.concat([pd.read_csv(_row_file(key, *row)) for row in rows], ignore_index=True)
+
+    # write table to file
+    with open(avg_deltaR_deltaRho_file, 'w') as f:
+        f.write('# Radius and bulk density differences based on a sample of low-mass ({:.1f}-{:.1f} Mearth) '
+                'and detectable (transit depth >{:.2E}) planets, excluding extreme irradiances '
+                '(>{:.0f} W/m2).\n'.format(*[planets_args[arg] for arg in ['M_min', 'M_max', 'depth_min', 'S_max']]))
+        f.write('# stage_key: {}\n'.format(key))
+        avg_deltaR_deltaRho.to_csv(f, index=False)
+    return avg_deltaR_deltaRho
+
+
+STAGES = ('sample', 'survey', 'fit')
+
+# hypothesis tests the pipeline can run: name -> (parameter_of_interest, binned)
+FITS = {'R': ('R', False),
+        'rho': ('rho', False),
+        'R_binned': ('R', True)}
+
+
+def save_pickle(obj, name):
+    """write an artifact of the pipeline to src/data/pipeline."""
+    with open(paths.data / 'pipeline/{}.pkl'.format(name), 'wb') as file:
+        pickle.dump(obj, file)
+
+
+def load_pickle(name):
+    """read an artifact of the pipeline from src/data/pipeline."""
+    with open(paths.data / 'pipeline/{}.pkl'.format(name), 'rb') as file:
+        return pickle.load(file)
+
+
+def fit_key(survey_key, fit):
+    """cache key of a hypothesis test, see `FITS`."""
+    parameter_of_interest, binned = FITS[fit]
+    hypothesis_args = get_hypothesis_args(parameter_of_interest)
+    hypothesis_args['binned'] = binned
+    return stage_key(survey_key, parameter_of_interest, hypothesis_args)
+
+
+def run_fit(fit, data, planets_args, survey_key):
+    """run (or load from the cache) one of the hypothesis tests in `FITS`."""
+    parameter_of_interest, binned = FITS[fit]
+    key = fit_key(survey_key, fit)
+    # the sampler draws from the global random state
+    seed_stage(key)
+    return cached_stage('fit', key, hypothesis_tests, data, planets_args, parameter_of_interest, binned)
+
+
+def run_fits(fits, data, planets_args, survey_key):
+    """Run several hypothesis tests on the same data concurrently, each in its own process.
+
+    Returns
+    -------
+    results : dict
+        fit name -> return value of `hypothesis_tests`
+    """
+    if len(fits) == 1:
+        return {fits[0]: run_fit(fits[0], data, planets_args, survey_key)}
+    with ProcessPoolExecutor(max_workers=len(fits)) as executor:
+        futures = {fit: executor.submit(run_fit, fit, data, planets_args, survey_key) for fit in fits}
+        return {fit: future.result() for fit, future in futures.items()}
 
 
-params, features, log, results_opt, h_magmaocean = hypothesis_tests()
-with open(paths.data / 'pipeline/params.pkl', 'wb') as file:
-    pickle.dump(params, file)
-with open(paths.data / 'pipeline/features.pkl', 'wb') as file:
-    pickle.dump(features, file)
-with open(paths.data / 'pipeline/log.pkl', 'wb') as file:
-    pickle.dump(log, file)
-with open(paths.data / 'pipeline/results_opt.pkl', 'wb') as file:
-    pickle.dump(results_opt, file)
-with open(paths.data / 'pipeline/h_magmaocean.pkl', 'wb') as file:
-    pickle.dump(h_magmaocean, file)
+def main(stages=STAGES, fits=('R',), chunk_size=None, prune=False):
+    """Run the pipeline and write its artifacts to src/data/pipeline.
 
+    Each stage is cached on a hash of its inputs, so that e.g. changing only the fit settings reuses the sample
+    and data. Stages that are not selected read their inputs from the artifacts of a previous run. The survey and
+    fit stages are seeded from their keys, so that their results do not depend on which stages hit the cache.
 
+    Parameters
+    ----------
+    stages : iterable of str
+        stages to run, any of 'sample', 'survey', 'fit'
+    fits : iterable of str
+        hypothesis tests to run, any of the keys of `FITS`. Several tests run concurrently on separate cores.
+        The 'R' test is written to results_opt.pkl and h_magmaocean.pkl, any other test to
+        results_<name>.pkl and h_magmaocean_<name>.pkl.
+    chunk_size : int
+        if given, generate planets for batches of this many stars at a time (for large d_max)
+    prune : bool
+        drop planets outside the mass and instellation cuts right after these are assigned, see `run_steps`
+    """
+    stars_args, planets_args = get_generator_args()
+    os.makedirs(paths.data / 'pipeline', exist_ok=True)
+    save_pickle(planets_args, 'planets_args')
+    save_pickle(stars_args, 'stars_args')
+
+    g_transit = generate_generator()
+    stars_key = stage_key(stars_args)
+    # pruned samples differ from unpruned ones; unpruned runs keep their earlier cache key
+    planets_key = stage_key(stars_key, planets_args, {'chunk_size': chunk_size} | ({'prune': True} if prune else {}))
+    survey_key = stage_key(planets_key, SURVEY_ARGS, MEASUREMENT_KEYS, PRECISION)
+
+    if 'sample' in stages:
+        stars, rng_state = cached_stage('stars', stars_key, generate_stars, g_transit)
+        sample = cached_stage('planets', planets_key, generate_planets, g_transit, stars, rng_state, chunk_size,
+                              prune)
+        save_pickle(sample, 'sample')
+        # compact per-column copy for the figure scripts
+        save_table(sample, paths.data / 'pipeline/sample_columns')
+        save_subsamples(sample, SUBSAMPLES, paths.data / 'pipeline/sample_columns')
+        # specs instead of the live objects, see `build_generator` and `build_survey`
+        save_pickle(generator_spec(), 'generator_spec')
+
+    if 'survey' in stages:
+        if 'sample' not in stages:
+            sample = load_pickle('sample')
+        # the measurement noise is drawn from the global random state
+        seed_stage(survey_key)
+        detected_opt, data, survey = cached_stage('survey', survey_key, survey_simulation, sample)
+        save_var_latex('N_optimistic', '500')  # round that to avoid confusion
+        save_pickle(data, 'data')
+        save_pickle(survey_spec(), 'survey_spec')
+
+    if 'fit' in stages:
+        if 'survey' not in stages:
+            data = load_pickle('data')
+        for fit, (params, features, log, results, h_magmaocean) in run_fits(list(fits), data, planets_args,
+                                                                             survey_key).items():
+            if fit == 'R':
+                save_pickle(params, 'params')
+                save_pickle(features, 'features')
+                save_pickle(log, 'log')
+                save_pickle(results, 'results_opt')
+                save_pickle(h_magmaocean, 'h_magmaocean')
+            else:
+                save_pickle(results, 'results_' + fit)
+                save_pickle(h_magmaocean, 'h_magmaocean_' + fit)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Generate the datasets for the paper.')
+    parser.add_argument('--stages', default=','.join(STAGES),
+                        help='comma-separated list of stages to run (default: {})'.format(','.join(STAGES)))
+    parser.add_argument('--fits', default='R',
+                        help='comma-separated list of hypothesis tests to run concurrently, any of {} '
+                             '(default: R)'.format(','.join(FITS)))
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help='generate planets for batches of this many stars at a time (default: all at once)')
+    parser.add_argument('--prune', action='store_true',
+                        help='drop planets outside the mass and instellation cuts as early as possible')
+    args = parser.parse_args()
+    stages = args.stages.split(',')
+    for stage in stages:
+        if stage not in STAGES:
+            parser.error('unknown stage: {}'.format(stage))
+    fits = args.fits.split(',')
+    for fit in fits:
+        if fit not in FITS:
+            parser.error('unknown fit: {}'.format(fit))
+    main(stages, fits, chunk_size=args.chunk_size, prune=args.prune)
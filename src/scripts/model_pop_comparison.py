@@ -1,8 +1,9 @@
 ## compare avg delta R/rho with expected from atmosphere models
-from scipy.interpolate import LinearNDInterpolator
+from functools import lru_cache
+from scipy.interpolate import RegularGridInterpolator
 
 import paths
-import pickle
+import artifacts
 import numpy as np
 import pandas as pd
 import seaborn as sns
@@ -11,10 +12,26 @@ from matplotlib import pyplot as plt
 import plotstyle
 plotstyle.styleplots()
 
-from bioverse.hypothesis import get_avg_deltaR_deltaRho, compute_avg_deltaR_deltaRho
+from bioverse.hypothesis import get_avg_deltaR_deltaRho
+from hzied_pipeline import build_avg_deltaR_deltaRho
 from bioverse.constants import DATA_DIR, CONST
 from cycler import cycler
 
+@lru_cache(maxsize=None)
+def get_deltaR_interpolator():
+    """interpolator of the radius differences from DL21 Fig. 3b on their regular (wrr x mass) grid."""
+    delta_R = pd.read_csv(DATA_DIR + 'deltaR_DornLichtenberg21_Fig3b.csv', comment='#')
+    delta_R.set_index('wrr', inplace=True)
+    wrr = delta_R.index.to_numpy(dtype=float)
+    mass = np.array([float(c) for c in delta_R.columns])
+
+    # the axes of RegularGridInterpolator must be strictly ascending
+    wrr_order, mass_order = np.argsort(wrr), np.argsort(mass)
+    values = delta_R.to_numpy()[wrr_order][:, mass_order]
+    return RegularGridInterpolator((wrr[wrr_order], mass[mass_order]), values, bounds_error=False,
+                                   fill_value=np.nan)
+
+
 def prepare_data():
     # Read M-R relations from Turbet+2020
     purerock = pd.read_csv(DATA_DIR + 'mass-radius_relationships_mgsio3_Zeng2016.txt')
@@ -22,80 +39,123 @@ def prepare_data():
     turbet2020 = pd.read_csv(DATA_DIR + 'mass-radius_relationships_STEAM_TURBET2020_FIG2b.dat', comment='#')
     mass_radius = purerock.append(turbet2020, ignore_index=True)
 
-    # Read radius differences from DL21 Fig. 3b
-    delta_R = pd.read_csv(DATA_DIR + 'deltaR_DornLichtenberg21_Fig3b.csv', comment='#')
-    delta_R.set_index('wrr', inplace=True)
-
-    # Combine Turbet+2020 and DL21 radius diffs:
+    # Combine Turbet+2020 and DL21 radius diffs (DL21 Fig. 3b):
     # interpolate within planet masses for the given water mass fraction wrr
-    x = delta_R.index.to_numpy()
-    y = np.array([float(c) for c in delta_R.columns])
-    z = delta_R.to_numpy().flatten()
-    grid = []
-    for xi in x:
-        for yi in y:
-            grid.append((xi, yi))
-    grid= np.array(grid)
-    interp = LinearNDInterpolator(list(grid), z)
-
-    mass_radius.loc[:,'radius_tot'] = mass_radius.radius + interp(mass_radius.wrr, mass_radius.mass)
+    interp = get_deltaR_interpolator()
+    mass_radius.loc[:,'radius_tot'] = mass_radius.radius + interp(np.column_stack([mass_radius.wrr, mass_radius.mass]))
     # plt.scatter(mass_radius.radius, mass_radius.radius_tot)
 
     # Read radius differences as measured in synthetic population
     # avg_deltaR_deltaRho = get_avg_deltaR_deltaRho()
-    with open(paths.data / 'pipeline/stars_args.pkl', 'rb') as f:
-        stars_args = pickle.load(f)
-    with open(paths.data / 'pipeline/planets_args.pkl', 'rb') as f:
-        planets_args = pickle.load(f)
-
-    try:
-        avg_deltaR_deltaRho = avg_deltaR_deltaRho = pd.read_csv(paths.data / 'avg_deltaR_deltaRho.csv', comment='#')
-    except:
-        avg_deltaR_deltaRho = compute_avg_deltaR_deltaRho(stars_args, planets_args, transiting_only=True, savefile=True)
-        # write table to file
-        with open(paths.data / 'avg_deltaR_deltaRho.csv', 'w') as f:
-            f.write('# Radius and bulk density differences based on a sample of low-mass ({:.1f}-{:.1f} Mearth) '
-                    'and detectable (transit depth >{:.2E}) planets, excluding extreme irradiances '
-                    '(>{:.0f} W/m2).\n'.format(*[planets_args[key] for key in ['M_min', 'M_max', 'depth_min', 'S_max']]))
-            avg_deltaR_deltaRho.to_csv(f, index=False)
+    stars_args = artifacts.load('stars_args')
+    planets_args = artifacts.load('planets_args')
+
+    # only rows (wrr, mechanisms) that have not been computed before are computed here. The comparison uses only
+    # the population with both the greenhouse radius increase and water incorporation.
+    avg_deltaR_deltaRho = build_avg_deltaR_deltaRho(stars_args, planets_args, wrrs=mass_radius.wrr.unique(),
+                                                    mechanisms=((True, True),), transiting_only=True)
     return mass_radius, avg_deltaR_deltaRho
 
-def plot_model_pop_comparison(mass_radius, target_mass, avg_deltaR_deltaRho):
+def index_by_wrr(mass_radius):
+    """Sort the mass-radius table by water mass fraction and mass for nearest-mass lookups.
+
+    Returns
+    -------
+    index : dict
+        'wrrs': water mass fractions in order of appearance, 'table': the table sorted by (wrr, mass),
+        'starts'/'stops': row range of each wrr in 'table', 'keys': sort keys for `np.searchsorted`
+    """
+    wrrs = mass_radius.wrr.unique()
+    group = pd.Series(np.arange(len(wrrs)), index=wrrs)[mass_radius.wrr].to_numpy()
+    order = np.lexsort((mass_radius.mass.to_numpy(), group))
+    table = mass_radius.iloc[order].reset_index(drop=True)
+    group = group[order]
+
+    # a single ascending key: group offset plus mass within the group
+    mass_min, span = table.mass.min(), table.mass.max() - table.mass.min() + 1.
+    return {'wrrs': wrrs,
+            'table': table,
+            'starts': np.searchsorted(group, np.arange(len(wrrs)), side='left'),
+            'stops': np.searchsorted(group, np.arange(len(wrrs)), side='right'),
+            'keys': group * span + (table.mass.to_numpy() - mass_min),
+            'mass_min': mass_min, 'span': span}
+
+
+def nearest_mass_rows(index, target_masses):
+    """rows of the indexed mass-radius table nearest in mass to each target mass, for every wrr.
+
+    Returns
+    -------
+    rows : np.ndarray
+        (n_target, n_wrr) positions in index['table']
+    """
+    table = index['table']
+    target_masses = np.clip(np.asarray(target_masses, dtype=float), table.mass.min(), table.mass.max())
+    group = np.arange(len(index['wrrs']))
+    target_keys = group[np.newaxis, :] * index['span'] + (target_masses[:, np.newaxis] - index['mass_min'])
+    pos = np.searchsorted(index['keys'], target_keys)
+
+    # the nearest mass is either right before or at the insertion point, within the same wrr group
+    lo = np.clip(pos - 1, index['starts'], index['stops'] - 1)
+    hi = np.clip(pos, index['starts'], index['stops'] - 1)
+    masses = table.mass.to_numpy()
+    return np.where(np.abs(masses[hi] - target_masses[:, np.newaxis]) < np.abs(masses[lo] - target_masses[:, np.newaxis]),
+                    hi, lo)
+
+
+def model_pop_difference(mass_radius, avg_deltaR_deltaRho, target_masses, x='R', index=None):
+    """Relative difference between the modeled radius/density change and the synthetic population mean.
+
+    Parameters
+    ----------
+    mass_radius : pd.DataFrame
+        mass-radius relations, see `prepare_data`
+    avg_deltaR_deltaRho : pd.DataFrame
+        average radius/density differences in the synthetic population
+    target_masses : array_like
+        planet masses to compare
+    x : str
+        'R' or 'rho'
+    index : dict
+        output of `index_by_wrr`, computed if None
+
+    Returns
+    -------
+    wrrs : np.ndarray
+        water mass fractions
+    difference : np.ndarray
+        (n_target, n_wrr) array
+    """
+    if index is None:
+        index = index_by_wrr(mass_radius)
+    wrrs, table = index['wrrs'], index['table']
+    rows = nearest_mass_rows(index, target_masses)
+    mass, radius, radius_tot = (table[col].to_numpy()[rows] for col in ('mass', 'radius', 'radius_tot'))
+
+    # dry radius/density at target mass
+    dry = list(wrrs).index(0.)
+    r2rho = lambda M, R: CONST['rho_Earth'] * M / R ** 3
+    if x == 'R':
+        dx_models = radius_tot - radius[:, [dry]]
+    elif x == 'rho':
+        dx_models = r2rho(mass, radius_tot) - r2rho(mass[:, [dry]], radius[:, [dry]])
+
+    pop = avg_deltaR_deltaRho[avg_deltaR_deltaRho.gh_increase & avg_deltaR_deltaRho.water_incorp]
+    dx_pop = pop.set_index('wrr')['delta_' + x].reindex(wrrs).to_numpy()
+    return wrrs, (dx_models - dx_pop[np.newaxis, :]) / dx_models
+
+
+def plot_model_pop_comparison(mass_radius, target_mass, avg_deltaR_deltaRho, target_masses=np.linspace(0.6, 1.8, 7)):
     fig, axs = plt.subplots(1, 2, figsize=[12, 4])
 
-    r2rho = lambda M, R: CONST['rho_Earth'] * M / R ** 3
+    index = index_by_wrr(mass_radius)
     for i, x in enumerate(['R', 'rho']):
         ax = axs[i]
-        for target_mass, color in zip(np.linspace(0.6, 1.8, 7),
-                                      cycler(color=reversed(sns.color_palette("rocket", n_colors=8, desat=None)))):
-            # compute dry radius at target mass
-            mr_dry = mass_radius[mass_radius.wrr == 0.]
-            mr_drym = mr_dry.iloc[(mr_dry.mass - target_mass).abs().argsort()[0], :]
-
-            if x == 'R':
-                dry_x = mr_drym.radius
-            elif x == 'rho':
-                dry_x = r2rho(mr_drym.mass, mr_drym.radius)
-
-            wrrs = mass_radius.wrr.unique()
-            dx_models = []
-            dx_pop = []
-            for wrri in wrrs:
-                # for each water mass fraction, compute difference between model and synthetic population mean
-                mrwrr = mass_radius[mass_radius.wrr == wrri]
-                mrwrr.reset_index(drop=True, inplace=True)
-                mrwrrm = mrwrr.iloc[(mrwrr.mass - target_mass).abs().argsort()[0], :]
-                if x == 'R':
-                    dx_models.append(mrwrrm.radius_tot - dry_x)
-                elif x == 'rho':
-                    dx_models.append(r2rho(mrwrrm.mass, mrwrrm.radius_tot) - dry_x)
-
-                dx_pop.append(avg_deltaR_deltaRho[avg_deltaR_deltaRho.gh_increase
-                                                  & avg_deltaR_deltaRho.water_incorp & (
-                                                              avg_deltaR_deltaRho.wrr == wrri)]['delta_' + x])
-
-            # plt.scatter(dx_models, dx_pop)
-            ax.plot(wrrs, np.subtract(np.array(dx_models), np.array(dx_pop).flatten()) / np.array(dx_models),
+        # for each water mass fraction, compute difference between model and synthetic population mean
+        wrrs, difference = model_pop_difference(mass_radius, avg_deltaR_deltaRho, target_masses, x=x, index=index)
+        for target_mass, dx, color in zip(target_masses, difference,
+                                          cycler(color=reversed(sns.color_palette("rocket", n_colors=len(target_masses) + 1, desat=None)))):
+            ax.plot(wrrs, dx,
                     label='{:.1f}'.format(target_mass),
                     color=color['color'])
         ax.set_xscale('log')
@@ -116,11 +176,8 @@ def plot_model_pop_comparison(mass_radius, target_mass, avg_deltaR_deltaRho):
     return fig, axs
 
 
-# target_mass = 1.0  # mass to compare in Earth masses
-# mass_radius, avg_deltaR_deltaRho = prepare_data()
-# fig, axs = plot_model_pop_comparison(mass_radius, target_mass, avg_deltaR_deltaRho)
-# fig.savefig(paths.figures / 'model_pop_comparison.pdf')
-
-# avoid expensive computation above and use static figure from previous run
-import os
-os.system('cp  {}/model_pop_comparison.pdf {}/model_pop_comparison.pdf'.format(paths.static, paths.figures))
\ No newline at end of file
+if __name__ == "__main__":
+    target_mass = 1.0  # mass to compare in Earth masses
+    mass_radius, avg_deltaR_deltaRho = prepare_data()
+    fig, axs = plot_model_pop_comparison(mass_radius, target_mass, avg_deltaR_deltaRho)
+    fig.savefig(paths.figures / 'model_pop_comparison.pdf')
\ No newline at end of file
@@ -1,17 +1,19 @@
 """Plot prototypical detection in an optimistic survey"""
 
-import pickle
 import paths
+import artifacts
 import numpy as np
 import matplotlib.pyplot as plt
 
 import plotstyle
 plotstyle.styleplots()
 
+from matplotlib.collections import LineCollection
 from bioverse.util import S2a_eff
-from bioverse.hypothesis import magma_ocean_hypo
+from utils import magma_ocean_hypo_batch, posterior_predictive_bands
 
-def plot_survey(data, results, planets_args, parameter_of_interest='R', show_rolling_mean=True, show_binned_stats=False):
+def plot_survey(data, results, planets_args, parameter_of_interest='R', show_rolling_mean=True, show_binned_stats=False,
+                thin=300, show_credible_band=False):
     yvar = parameter_of_interest
     xvar = 'S_abs'
     # yvar = 'R'
@@ -35,25 +37,30 @@ def plot_survey(data, results, planets_args, parameter_of_interest='R', show_rol
     # overplot samples from the posterior
     nburn = 100
     sampler_results = results['sampler_results']
-    posterior_sample = sampler_results.samples[nburn::300]
+    posterior_sample = sampler_results.samples[nburn::thin]
 
     S_grid = np.geomspace(10., 2000., 300)
     a_eff_grid = S2a_eff(S_grid)
+    hypo_kwargs = dict(gh_increase=planets_args['gh_increase'], water_incorp=planets_args['water_incorp'],
+                       simplified=planets_args['simplified'], parameter_of_interest=parameter_of_interest)
 
+    # evaluate all draws at once and draw them as a single collection
+    P_magma = magma_ocean_hypo_batch(posterior_sample, a_eff_grid, **hypo_kwargs)
     colors = plt.cm.OrRd(np.linspace(0, 1, len(posterior_sample)))
-    for i, s in enumerate(posterior_sample):
-        P_magma = magma_ocean_hypo((s[0], s[1], s[2], s[3]), a_eff_grid,
-                                   gh_increase=planets_args['gh_increase'], water_incorp=planets_args['water_incorp'],
-                                   simplified=planets_args['simplified'], parameter_of_interest=parameter_of_interest)
-        ax.plot(S_grid, P_magma,
-                c=colors[i],
-                # c='k',
-                alpha=.5, lw=1.)
-    ax.plot(S_grid, P_magma,
-            c=colors[i],
+    segments = np.stack([np.broadcast_to(S_grid, P_magma.shape), P_magma], axis=-1)
+    ax.add_collection(LineCollection(segments, colors=colors, alpha=.5, lw=1.))
+    ax.plot(S_grid, P_magma[-1],
+            c=colors[-1],
             #         # c='k',
             alpha=.63, lw=1., label='posterior draws')
 
+    if show_credible_band:
+        # 68% credible band from the full, importance-weighted nested sampling run
+        weights = np.exp(sampler_results.logwt - sampler_results.logz[-1])
+        lo, median, hi = posterior_predictive_bands(sampler_results.samples, a_eff_grid, weights=weights,
+                                                    **hypo_kwargs)
+        ax.fill_between(S_grid, lo, hi, color='C1', alpha=.3, label='68% credible band')
+
     ax.set_xscale('log')
     # ax.set_yscale('log')
     if xvar == 'S_abs':
@@ -87,12 +94,9 @@ def plot_survey(data, results, planets_args, parameter_of_interest='R', show_rol
 
 
 
-with open(paths.data / 'pipeline/data.pkl', 'rb') as f:
-    data = pickle.load(f)
-with open(paths.data / 'pipeline/results_opt.pkl', 'rb') as f:
-    results_opt = pickle.load(f)
-with open(paths.data / 'pipeline/planets_args.pkl', 'rb') as f:
-    planets_args = pickle.load(f)
+data = artifacts.load('data')
+results_opt = artifacts.load('results_opt')
+planets_args = artifacts.load('planets_args')
 
 
 fig, ax = plot_survey(data, results_opt, planets_args, parameter_of_interest='R', show_rolling_mean=True, show_binned_stats=False)
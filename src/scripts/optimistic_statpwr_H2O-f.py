@@ -1,5 +1,4 @@
 import paths
-import pickle
 import numpy as np
 import cmocean
 import matplotlib.pyplot as plt
@@ -8,22 +7,25 @@ import plotstyle
 plotstyle.styleplots()
 
 from bioverse import analysis, plots
+from sweep import run_sweep
+import columnar
 
-def statistical_power_grid():
+def statistical_power_grid(h_magmaocean, g_spec, survey_spec, planets_args, processes=None):
+    """compute the statistical power grid. Finished cells are kept in src/data/sweeps, so that an interrupted
+    run resumes where it stopped."""
     wrr_grid = [0., 0.0001,0.001, 0.005, 0.01, 0.02, 0.03, 0.04, 0.05]
     # wrr_grid = [0.0001, 0.005, 0.05]
     f_rgh_grid = np.linspace(0., 1., len(wrr_grid))
 
     reduced_args = {key: planets_args[key] for key in planets_args if (key != 'wrr') & (key != 'f_rgh')} # remove keys used in the grid
     # results_grid = analysis.test_hypothesis_grid(h_magmaocean, g_transit, survey, wrr=wrr_grid, f_rgh=f_rgh_grid, N=20, processes=8, **reduced_args)
-    results_grid = analysis.test_hypothesis_grid(h_magmaocean, g_transit, survey, wrr=wrr_grid, f_rgh=f_rgh_grid,
-                                                 N=20, processes=8, return_chains=True, **reduced_args)
+    results_grid = run_sweep(h_magmaocean, g_spec, survey_spec, paths.data / 'sweeps/optimistic_H2O-f-grid',
+                             N=20, processes=processes, wrr=wrr_grid, f_rgh=f_rgh_grid, **reduced_args)
     return results_grid
 
 def load_grid():
     """load previously computed statistical power grid"""
-    with open(paths.data / 'bioverse_objects/optimistic_H2O-f-grid_G16.pkl', 'rb') as f:
-        results_grid = pickle.load(f)
+    results_grid = columnar.load_grid('optimistic_H2O-f-grid_G16.pkl')
     wrr_grid = [0., 0.0001,0.001, 0.005, 0.01, 0.02, 0.03, 0.04, 0.05]
     f_rgh_grid = np.linspace(0., 1., len(wrr_grid))
     return results_grid, wrr_grid, f_rgh_grid
@@ -1,5 +1,5 @@
 import paths
-import pickle
+import artifacts
 from warnings import warn
 import numpy as np
 import matplotlib.pyplot as plt
@@ -7,6 +7,7 @@ from matplotlib.ticker import ScalarFormatter
 
 import plotstyle
 plotstyle.styleplots()
+from columnar import load_grid
 
 
 def plot_posterior_hist(results_grid, fig=None, ax=None, truth=None, seed=42, param_idx=0, **grid_kwargs):
@@ -165,18 +166,16 @@ def plot_plato_Sthresh_grid(grids, planets_args):
 
 
 if __name__ == "__main__":
-    with open(paths.data / 'pipeline/planets_args.pkl', 'rb') as f:
-        planets_args = pickle.load(f)
+    planets_args = artifacts.load('planets_args')
 
     """load previously computed hypothesis test grids"""
     hypothesisgrids = {'res_fg_plato100' : 'plato100_f-grid.pkl',
                        'res_fg_plato_rho': 'plato_rho_f-grid.pkl',
                        'res_fg_plato_M_rho_100':'plato_M_rho_100.pkl',}
-    for varname, path in zip(hypothesisgrids.keys(),
-                             [str(paths.data) + '/bioverse_objects/' + fname for fname in hypothesisgrids.values()]):
-        with open(path, 'rb') as f:
-            loaded_obj = pickle.load(f)
-            exec(varname + '= loaded_obj')
+    for varname, fname in hypothesisgrids.items():
+        # chains are read lazily, only for the simulations shown in the figure
+        loaded_obj = load_grid(fname)
+        exec(varname + '= loaded_obj')
     grids = [res_fg_plato100, res_fg_plato_rho, res_fg_plato_M_rho_100]
     fig, axs = plt.subplots(nrows=6, ncols=3)
     fig, axs = plot_plato_Sthresh_grid(grids, planets_args)
@@ -1,5 +1,4 @@
 import paths
-import pickle
 import numpy as np
 import matplotlib.pyplot as plt
 from scipy.interpolate import interp1d
@@ -9,6 +8,7 @@ import plotstyle
 plotstyle.styleplots()
 
 from bioverse import analysis, plots
+from columnar import load_grid
 
 
 def plot_plato_grids(f_grid, results, labels, yaxis='dlnZ', interpolate=False, plot_percentiles=False,
@@ -73,11 +73,10 @@ hypothesisgrids = {'res_fg_plato': 'plato_f-grid.pkl',
                    'res_fg_plato_FGK_rho':'plato_FGK_rho.pkl', # FGK vs M
                    'res_fg_plato_M_R':'plato_M_R.pkl',
                    'res_fg_plato_M_rho':'plato_M_rho.pkl',} # FGK vs M
-for varname, path in zip(hypothesisgrids.keys(),
-                         [str(paths.data) + '/bioverse_objects/' + fname for fname in hypothesisgrids.values()]):
-    with open(path, 'rb') as f:
-        loaded_obj = pickle.load(f)
-        exec(varname + '= loaded_obj')
+for varname, fname in hypothesisgrids.items():
+    # columnar store: reads only the arrays used below (dlnZ, N_pl), not the chains
+    loaded_obj = load_grid(fname)
+    exec(varname + '= loaded_obj')
 
 N_plato = np.rint(res_fg_plato['N_pl'].mean())
 num_grid = 11 # number of points in the grid
@@ -1,13 +1,14 @@
 """Plot Radius evolution of different planet types, illustrating degeneracies
 and potential for confusion among planet classes.
 """
-import pickle
 # import hzied_pipeline
 
 from bioverse.constants import CONST
 
 import paths
+import artifacts
 import numpy as np
+import pandas as pd
 import seaborn as sns
 
 from matplotlib import pyplot as plt
@@ -15,7 +16,8 @@ import plotstyle
 plotstyle.styleplots()
 
 from matplotlib.ticker import ScalarFormatter
-from scipy.interpolate import splrep, BSpline, interp1d
+from scipy.interpolate import splrep, BSpline, PchipInterpolator
+from columnar import load_sample
 
 
 def interpolate_grid(t, R):
@@ -25,27 +27,57 @@ def interpolate_grid(t, R):
     return 10 ** t_fine, BSpline(*tck)(t_fine)
 
 
+def binned_MR_curves(sample, M_bins=np.linspace(0.3, 2., 35)):
+    """Reduce the population to median radii in bins of planet mass and interpolate them.
+
+    Parameters
+    ----------
+    sample : pandas DataFrame
+        synthetic sample with columns M, R, R_orig, has_magmaocean and optionally R_steam
+    M_bins : array_like
+        edges of the mass bins
+
+    Returns
+    -------
+    curves : dict
+        monotone interpolators M -> R for 'R_orig' (all planets) and 'R', 'R_steam' (planets with a magma ocean)
+    """
+    mo = sample['has_magmaocean'].to_numpy(dtype=bool)
+    # R and R_steam only of planets with a magma ocean, R_orig of all planets
+    binned = pd.DataFrame({'M': sample['M'], 'R_orig': sample['R_orig'],
+                           'M_mo': sample['M'].where(mo), 'R': sample['R'].where(mo)})
+    if 'R_steam' in sample:
+        binned['R_steam'] = sample['R_steam'].where(mo)
+
+    # one pass over the population; the median skips the masked rows
+    medians = binned.groupby(pd.cut(binned['M'], M_bins).rename('M_bin'), observed=True).median()
+
+    curves = {}
+    for colname, M_col in (('R_orig', 'M'), ('R', 'M_mo'), ('R_steam', 'M_mo')):
+        if colname not in medians:
+            continue
+        curve = medians[[M_col, colname]].dropna().sort_values(M_col)
+        curves[colname] = PchipInterpolator(curve[M_col].to_numpy(), curve[colname].to_numpy(), extrapolate=True)
+    return curves
+
+
 def plot_radiuscomparison(sample, planets_args):
-    dd = sample.to_pandas()
-    d = dd.sample(min([len(dd), 4000]))
-    mo = dd[dd.has_magmaocean].sample(min([len(dd[dd.has_magmaocean]), 4000]))
+    try:
+        dd = sample.to_pandas()
+    except AttributeError:
+        dd = sample
+    curves = binned_MR_curves(dd)
 
     fig, ax = plt.subplots()
 
-    def interpolate_MR(df, colname):
-        # interpolate M-R relation
-        return interp1d(df.M, df[colname], kind='quadratic')
-
     M = np.linspace(0.33, 1.9, num=200)
-    try:
-        ax.plot(M, interpolate_MR(mo.sort_values('M'), 'R_steam')(M),
+    if 'R_steam' in curves:
+        ax.plot(M, curves['R_steam'](M),
                 lw=2., label='dry melt', c='xkcd:dark grey', ls='--')
-    except AttributeError:
-        pass
-    ax.plot(M, interpolate_MR(mo.sort_values('M'), 'R')(M),
+    ax.plot(M, curves['R'](M),
             lw=3., label='wet melt', c='C2')
 
-    ax.plot(M, interpolate_MR(d.sort_values('M'), 'R_orig')(M),
+    ax.plot(M, curves['R_orig'](M),
             lw=3., label='non-\nrunaway', c='C0')
 
     ax.set_xlabel('$M_P \,[M_\oplus]$')
@@ -56,10 +88,12 @@ def plot_radiuscomparison(sample, planets_args):
     ax.set_xlim(right=2.24)
     ax.set_ylim(top=1.47)
 
-    for y, lbl, c in zip([max(mo.R_steam) + 0.01, max(mo.R) - 0.04, max(d.R_orig) - 0.03],
-                         ax.get_legend_handles_labels()[1], ['xkcd:dark grey', 'C2', 'C0']):
-        ax.annotate(lbl, xy=(1.93, y), c=c, va='center')
+    # label the curves at their right end
+    for col, lbl, c in zip([col for col in ('R_steam', 'R', 'R_orig') if col in curves],
+                           ax.get_legend_handles_labels()[1], ['xkcd:dark grey', 'C2', 'C0'][-len(curves):]):
+        ax.annotate(lbl, xy=(1.93, curves[col](M[-1])), c=c, va='center')
 
+    mo = dd[dd.has_magmaocean]
     radius_change = np.average(mo.R / mo.R_orig) - 1
     # print('avg radius change of runaway GH planets: {:+.0f} %'.format(100 * radius_change))
     density_change = np.average(mo.rho / (CONST['rho_Earth'] * mo.M / mo.R_orig ** 3)) - 1
@@ -116,10 +150,8 @@ def plot_planet_evo(N_time=9, v_offset=0.004, interpolate=False, **kwargs):
 
     return fig, ax
 
-with open(paths.data / 'pipeline/planets_args.pkl', 'rb') as f:
-    planets_args = pickle.load(f)
-with open(paths.data / 'pipeline/sample.pkl', 'rb') as f:
-    sample = pickle.load(f)
+planets_args = artifacts.load('planets_args')
+sample = load_sample(columns=['M', 'R', 'R_orig', 'R_steam', 'rho', 'has_magmaocean'])
 
 fig, ax = plot_radiuscomparison(sample, planets_args)
 fig.savefig(paths.figures / 'radiuscomparison.pdf')
@@ -0,0 +1,77 @@
+"""
+Read-only Bioverse Tables in shared memory.
+
+`publish_table` copies the numeric columns of a Table into a single shared memory block. Worker processes receive
+only a small handle and `attach_table` maps the columns as zero-copy, read-only arrays. This way, e.g. the star
+catalog of a sweep is held in memory once per node instead of once per worker.
+"""
+
+from multiprocessing import shared_memory
+import numpy as np
+from bioverse.classes import Table
+
+# shared memory blocks attached by this process, kept open as long as their arrays are in use
+_attached = {}
+
+
+def publish_table(table):
+    """Copy a table into a new shared memory block.
+
+    Columns of Python objects cannot be shared and are sent along with the handle instead.
+
+    Parameters
+    ----------
+    table : Bioverse Table or dict of arrays
+        the table to publish
+
+    Returns
+    -------
+    shm : SharedMemory
+        the shared memory block. The caller owns it and must `close()` and `unlink()` it when done.
+    handle : dict
+        picklable description of the block, see `attach_table`
+    """
+    layout, objects, offset = {}, {}, 0
+    columns = {key: np.asarray(table[key]) for key in table.keys()}
+    for key, col in columns.items():
+        if col.dtype.hasobject:
+            objects[key] = col
+            continue
+        # align each column to 64 bytes
+        offset = -(-offset // 64) * 64
+        layout[key] = (col.dtype.str, col.shape, offset)
+        offset += col.nbytes
+
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for key, (dtype, shape, start) in layout.items():
+        np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)[...] = columns[key]
+    return shm, {'name': shm.name, 'columns': list(columns), 'layout': layout, 'objects': objects}
+
+
+def attach_table(handle):
+    """Map a table published with `publish_table` without copying it.
+
+    Parameters
+    ----------
+    handle : dict
+        handle returned by `publish_table`
+
+    Returns
+    -------
+    table : Bioverse Table
+        the table, with read-only columns. New columns can be added as usual.
+    """
+    if handle['name'] not in _attached:
+        _attached[handle['name']] = shared_memory.SharedMemory(name=handle['name'])
+    shm = _attached[handle['name']]
+
+    table = Table()
+    for key in handle['columns']:
+        if key in handle['objects']:
+            table[key] = handle['objects'][key]
+            continue
+        dtype, shape, start = handle['layout'][key]
+        col = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)
+        col.flags.writeable = False
+        table[key] = col
+    return table
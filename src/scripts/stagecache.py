@@ -0,0 +1,87 @@
+"""
+Content-addressed cache for the stages of the pipeline.
+
+Each stage result is pickled to `src/data/cache/<stage>-<key>.pkl`, where `key` is a hash of everything
+the stage depends on (generator arguments, survey precisions, fit settings, and the key of the upstream stage).
+The cache lives outside of `src/data/pipeline` because Snakemake removes rule outputs before re-running a rule.
+"""
+
+import os
+import json
+import pickle
+import hashlib
+import numpy as np
+import paths
+
+cache_dir = paths.data / 'cache'
+
+
+def _to_builtin(obj):
+    """make numpy objects json-serializable."""
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return repr(obj)
+
+
+def stage_key(*parts):
+    """Compute a short content hash of the arguments a stage depends on.
+
+    Parameters
+    ----------
+    *parts
+        dicts, tuples, arrays or scalars describing the stage inputs. Pass the key of the
+        upstream stage to chain the stages.
+
+    Returns
+    -------
+    key : str
+        hexadecimal hash
+    """
+    blob = json.dumps(parts, sort_keys=True, default=_to_builtin)
+    return hashlib.sha1(blob.encode()).hexdigest()[:16]
+
+
+def seed_stage(key):
+    """Seed numpy's global random state from the key of a stage.
+
+    Bioverse draws from the global random state, which is only carried over between stages that run in the same
+    process without a cache hit. Seeding every random stage from its key makes its result independent of which
+    upstream stages were loaded from the cache or run in an earlier invocation.
+    """
+    np.random.seed(int(key, 16) % 2 ** 32)
+
+
+def cached_stage(stage, key, func, *args, **kwargs):
+    """Return the result of `func(*args, **kwargs)`, loading it from the cache if possible.
+
+    Parameters
+    ----------
+    stage : str
+        name of the stage, e.g. 'stars' or 'fit'
+    key : str
+        content hash of the stage inputs, see `stage_key`
+    func : callable
+        function computing the stage result
+
+    Returns
+    -------
+    result
+        the (possibly cached) return value of `func`
+    """
+    filename = cache_dir / '{}-{}.pkl'.format(stage, key)
+    if filename.exists():
+        print('Using cached {} stage ({})'.format(stage, key))
+        with open(filename, 'rb') as f:
+            return pickle.load(f)
+
+    result = func(*args, **kwargs)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # write atomically so that an interrupted run never leaves a corrupt cache entry
+    tmpfile = filename.with_suffix('.tmp')
+    with open(tmpfile, 'wb') as f:
+        pickle.dump(result, f)
+    os.replace(tmpfile, filename)
+    return result
@@ -0,0 +1,345 @@
+"""
+Process-parallel sweep engine for statistical power grids.
+
+A sweep runs the generator, the survey and the hypothesis fit for every cell of a grid of generator arguments
+(e.g. wrr x f_rgh) and N realisations per cell. Every finished cell is written to its own file as soon as it
+completes, so that a killed sweep resumes from the cells already on disk. `collect_sweep` assembles the cells into
+a results grid in the format of `bioverse.analysis.test_hypothesis_grid`.
+
+Unless the grid varies a star generation argument, the star catalog is generated once and shared read-only with
+all workers through shared memory; the workers only run the planet steps. In batch mode, the N realisations of a
+grid point are generated together in one pass of the planet steps. With `reuse_population`, each realisation's
+population is generated once up to the magma_ocean step and only the remaining steps are replayed for every cell.
+"""
+
+import os
+import json
+import time
+import pickle
+import itertools
+import multiprocessing
+from warnings import warn
+from collections import OrderedDict
+import numpy as np
+from bioverse.classes import Table
+from utils import adaptive_fit
+from hzied_pipeline import (build_generator, build_survey, run_steps, get_generator_args, generate_realisations,
+                            split_realisations, snapshot_population, replay_population, upstream_args, STAR_STEPS)
+from sharedtable import publish_table, attach_table
+from stagecache import stage_key
+
+MANIFEST_FILE = 'sweep.json'
+
+
+def default_processes():
+    """number of cores available to this process."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count()
+
+
+def _make_grid(N, **grid_kwargs):
+    grid = OrderedDict((key, np.atleast_1d(val)) for key, val in grid_kwargs.items())
+    grid['N'] = np.arange(N)
+    return grid
+
+
+def _cell_file(outdir, idx):
+    return os.path.join(outdir, 'cell_{}.pkl'.format('_'.join(str(i) for i in idx)))
+
+
+def _describe_hypothesis(h):
+    """the settings of a hypothesis and its null hypothesis that determine the fits, for the manifest key."""
+    if h is None:
+        return None
+    description = {attr: getattr(h, attr, None) for attr in ('params', 'bounds', 'log', 'features', 'labels')}
+    description['function'] = getattr(getattr(h, 'f', None), '__name__', None)
+    description['h_null'] = _describe_hypothesis(getattr(h, 'h_null', None))
+    return description
+
+
+def _check_manifest(outdir, key):
+    """record the key of a sweep in its directory, or make sure that the cells on disk belong to the same sweep."""
+    filename = os.path.join(outdir, MANIFEST_FILE)
+    if os.path.exists(filename):
+        with open(filename) as f:
+            found = json.load(f)['stage_key']
+        if found != key:
+            raise ValueError('{} holds the cells of a different sweep (key {}, expected {}); remove it or choose '
+                             'another outdir'.format(outdir, found, key))
+        return
+    if any(name.startswith('cell_') for name in os.listdir(outdir)):
+        raise ValueError('{} holds cells without a {}; cannot tell which sweep they belong to'.format(
+            outdir, MANIFEST_FILE))
+    with open(filename, 'w') as f:
+        json.dump({'stage_key': key}, f)
+
+
+# objects shared by all tasks of a worker process, set by `_init_worker`
+_worker = {}
+
+
+def _init_worker(h, g_spec, survey_spec, stars_handle=None):
+    # only the specs are sent to the workers; the objects are built once per worker
+    _worker['h'] = h
+    _worker['g'], _worker['survey'] = build_generator(g_spec), build_survey(survey_spec)
+    _worker['stars'] = None if stars_handle is None else attach_table(stars_handle)
+
+
+def _run_cell(task):
+    """generate a sample, observe it and fit the hypothesis for one grid cell."""
+    idx, gen_kwargs, fit_kwargs, adaptive, filename = task
+    h, g, survey, stars = _worker['h'], _worker['g'], _worker['survey'], _worker['stars']
+
+    if stars is None:
+        sample = g.generate(**gen_kwargs)
+    else:
+        # planet steps on the shared star catalog
+        np.random.seed(gen_kwargs['seed'])
+        sample = run_steps(g, stars, idx_start=len(STAR_STEPS), **gen_kwargs)
+    return idx, _fit_cell(h, survey, sample, fit_kwargs, adaptive, filename)
+
+
+def _run_group(task):
+    """generate all realisations of one grid point at once, then observe and fit the missing ones."""
+    grid_idx, gen_kwargs, seed, N, missing, fit_kwargs, adaptive = task
+    h, g, survey, stars = _worker['h'], _worker['g'], _worker['survey'], _worker['stars']
+
+    if stars is None:
+        # read_stars_Gaia seeds itself from its `seed` argument, so the derived seed is passed as an override
+        star_seed = int(seed.generate_state(1)[0])
+        np.random.seed(star_seed)
+        stars = run_steps(g, Table(), idx_stop=len(STAR_STEPS), **gen_kwargs | {'seed': star_seed})
+    # all N realisations are generated, so that the samples do not depend on which cells are on disk
+    samples = split_realisations(generate_realisations(g, stars, N, seed=seed, **gen_kwargs), N)
+    return [(grid_idx + (n,), _fit_cell(h, survey, samples[n], fit_kwargs, adaptive, filename))
+            for n, filename in missing]
+
+
+def _run_realisation(task):
+    """generate one realisation up to the magma_ocean step, then replay the remaining steps for its missing cells."""
+    fixed_kwargs, seed, cells, fit_kwargs, adaptive = task
+    h, g, survey, stars = _worker['h'], _worker['g'], _worker['survey'], _worker['stars']
+
+    if stars is None:
+        # as in `_run_group`, the derived seed must override the seed argument of read_stars_Gaia
+        star_seed = int(seed.generate_state(1)[0])
+        np.random.seed(star_seed)
+        stars = run_steps(g, Table(), idx_stop=len(STAR_STEPS), **fixed_kwargs | {'seed': star_seed})
+    snapshot = snapshot_population(g, stars, seed=seed, **fixed_kwargs)
+    results = []
+    for idx, gen_kwargs, filename in cells:
+        sample = replay_population(g, snapshot, **gen_kwargs)
+        results.append((idx, _fit_cell(h, survey, sample, fit_kwargs, adaptive, filename)))
+    return results
+
+
+def _fit_cell(h, survey, sample, fit_kwargs, adaptive, filename):
+    """observe a sample, fit the hypothesis and write the results of the cell to disk."""
+    detected = survey.compute_yield(sample)
+    data = survey.observe(detected, demographics=True)
+    if adaptive:
+        results = adaptive_fit(h, data, **fit_kwargs)
+    else:
+        results = h.fit(data, return_chains=True, **fit_kwargs)
+
+    cell = {key: val for key, val in results.items() if key != 'sampler_results'}
+    cell['N_pl'] = len(data)
+
+    # write atomically so that a killed sweep never leaves a truncated cell behind
+    with open(filename + '.tmp', 'wb') as f:
+        pickle.dump(cell, f)
+    os.replace(filename + '.tmp', filename)
+    return cell
+
+
+def run_sweep(h, g_spec, survey_spec, outdir, N=20, processes=None, seed=42, fit_kwargs=None, adaptive=False,
+              share_stars=True, batch=False, reuse_population=False, **kwargs):
+    """Run a statistical power grid, streaming each finished cell to disk.
+
+    Parameters
+    ----------
+    h : Bioverse Hypothesis
+        hypothesis to test, including its null hypothesis
+    g_spec : dict
+        spec of the generator for the synthetic samples, see `hzied_pipeline.generator_spec`
+    survey_spec : dict
+        spec of the survey observing the samples, see `hzied_pipeline.survey_spec`
+    outdir : str or Path
+        directory holding one file per finished cell. Cells already present are skipped. The directory also holds
+        a manifest with a hash of all sweep settings, including those of `h`; resuming with different settings
+        raises a ValueError.
+    N : int
+        number of realisations per grid cell
+    processes : int
+        size of the process pool. Defaults to the number of available cores.
+    seed : int
+        base seed; each realisation (or, in batch mode, each grid point) gets its own seed derived from its
+        position in the grid.
+    fit_kwargs : dict
+        keyword arguments for `Hypothesis.fit`, or for `utils.adaptive_fit` if `adaptive`
+    adaptive : bool
+        if true, grow the nested sampling budget of each fit only until its verdict is certain
+    share_stars : bool
+        generate the star catalog once (with `seed`) and share it with all workers, instead of generating it for
+        every realisation. Ignored if the grid varies a star generation argument. Note that all realisations
+        then share the same stars (including their randomly drawn ages).
+    batch : bool
+        generate the N realisations of a grid point together in one pass of the planet steps (see
+        `hzied_pipeline.generate_realisations`), seeded with streams spawned from `seed`. One task per grid point
+        then generates, observes and fits all of its missing realisations.
+    reuse_population : bool
+        generate each realisation only once up to the magma_ocean step (see `hzied_pipeline.snapshot_population`)
+        and replay only magma_ocean, compute_transit_params and apply_bias for every grid point. One task per
+        realisation then handles all of its missing cells. Requires that the grid varies only arguments of these
+        steps, e.g. wrr and f_rgh.
+    **kwargs
+        generator arguments. Array-like values span the grid, scalars are passed to every cell.
+
+    Returns
+    -------
+    results_grid : dict
+        results of all cells, see `collect_sweep`
+    """
+    if batch and reuse_population:
+        raise ValueError('batch and reuse_population are mutually exclusive')
+    outdir = str(outdir)
+    os.makedirs(outdir, exist_ok=True)
+    fit_kwargs = {} if fit_kwargs is None else fit_kwargs
+    grid_kwargs = {key: val for key, val in kwargs.items() if np.ndim(val) > 0}
+    fixed_kwargs = {key: val for key, val in kwargs.items() if np.ndim(val) == 0}
+    grid = _make_grid(N, **grid_kwargs)
+    shape = tuple(len(val) for val in grid.values())
+    mode = {'share_stars': share_stars, 'batch': batch, 'reuse_population': reuse_population}
+    _check_manifest(outdir, stage_key(_describe_hypothesis(h), grid, fixed_kwargs, N, seed, g_spec, survey_spec,
+                                      fit_kwargs, adaptive, mode))
+
+    tasks = []
+    for flat_idx, idx in enumerate(itertools.product(*[range(n) for n in shape])):
+        filename = _cell_file(outdir, idx)
+        if os.path.exists(filename):
+            continue
+        gen_kwargs = dict(fixed_kwargs)
+        gen_kwargs.update({key: grid[key][i] for key, i in zip(grid_kwargs, idx)})
+        gen_kwargs['seed'] = seed + flat_idx
+        tasks.append((idx, gen_kwargs, fit_kwargs, adaptive, filename))
+
+    N_total = int(np.prod(shape))
+    N_done = N_total - len(tasks)
+    print('Sweep over {} cells: {} on disk, {} to run.'.format(N_total, N_done, len(tasks)))
+    N_todo = len(tasks)
+
+    if reuse_population:
+        varied = set(grid_kwargs) & upstream_args(build_generator(g_spec))
+        if varied:
+            raise ValueError('cannot reuse the population: the grid varies {}, which the steps before magma_ocean '
+                             'use'.format(', '.join(sorted(varied))))
+
+    run_task = _run_cell
+    if reuse_population:
+        # one task per realisation, each with its own spawned seed stream for the snapshot
+        seeds = np.random.SeedSequence(seed).spawn(N)
+        realisations = OrderedDict()
+        for idx, gen_kwargs, _, _, filename in tasks:
+            realisations.setdefault(idx[-1], []).append((idx, gen_kwargs, filename))
+        tasks = [(fixed_kwargs, seeds[n], cells, fit_kwargs, adaptive) for n, cells in realisations.items()]
+        run_task = _run_realisation
+    elif batch:
+        # one task per grid point, each with its own spawned seed stream
+        grid_points = list(itertools.product(*[range(n) for n in shape[:-1]]))
+        seeds = dict(zip(grid_points, np.random.SeedSequence(seed).spawn(len(grid_points))))
+        groups = OrderedDict()
+        for idx, _, _, _, filename in tasks:
+            groups.setdefault(idx[:-1], []).append((idx[-1], filename))
+        tasks = [(grid_idx, {key: grid[key][i] for key, i in zip(grid_kwargs, grid_idx)} | fixed_kwargs,
+                  seeds[grid_idx], N, missing, fit_kwargs, adaptive)
+                 for grid_idx, missing in groups.items()]
+        run_task = _run_group
+
+    if tasks:
+        processes = min(processes or default_processes(), len(tasks))
+        stars_args, _ = get_generator_args()
+        shm, stars_handle = None, None
+        if share_stars and not set(grid_kwargs) & set(stars_args):
+            np.random.seed(seed)
+            stars = run_steps(build_generator(g_spec), Table(), idx_stop=len(STAR_STEPS), **fixed_kwargs)
+            shm, stars_handle = publish_table(stars)
+            del stars
+        t_start = time.time()
+        try:
+            with multiprocessing.Pool(processes, initializer=_init_worker,
+                                      initargs=(h, g_spec, survey_spec, stars_handle)) as pool:
+                i = 0
+                for result in pool.imap_unordered(run_task, tasks):
+                    for idx, cell in (result if run_task is not _run_cell else [result]):
+                        i += 1
+                        elapsed = time.time() - t_start
+                        print('[{}/{}] cell {}: dlnZ = {:.1f} ({:.0f} s elapsed, ~{:.0f} s remaining)'.format(
+                            N_done + i, N_total, idx, cell['dlnZ'], elapsed, elapsed / i * (N_todo - i)))
+        finally:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+    results_grid = collect_sweep(outdir, h=h, N=N, **grid_kwargs)
+    if adaptive and 'ncall_total' in results_grid:
+        ncall_total, ncall_fixed = np.nansum(results_grid['ncall_total']), np.nansum(results_grid['ncall_fixed'])
+        print('Adaptive fits: {:.0f} likelihood calls, {:.0%} of the fixed budget ({:.0f} calls)'.format(
+            ncall_total, ncall_total / ncall_fixed, ncall_fixed))
+        N_unconverged = int(np.sum(results_grid['converged'] == 0)) if 'converged' in results_grid else 0
+        if N_unconverged:
+            warn('{} of {} adaptive fits did not converge, see results_grid["converged"]'.format(
+                N_unconverged, int(np.sum(np.isfinite(results_grid['converged'])))))
+    return results_grid
+
+
+def collect_sweep(outdir, h=None, N=20, **grid_kwargs):
+    """Assemble the cells of a (possibly unfinished) sweep into a results grid.
+
+    Missing cells are filled with NaN.
+
+    Parameters
+    ----------
+    outdir : str or Path
+        directory holding the cell files
+    h : Bioverse Hypothesis
+        tested hypothesis, stored in the results grid
+    N : int
+        number of realisations per grid cell
+    **grid_kwargs
+        the grid axes, e.g. wrr=wrr_grid, f_rgh=f_rgh_grid
+
+    Returns
+    -------
+    results_grid : dict
+        'grid' holds the grid axes including 'N', all other entries are arrays over the grid.
+    """
+    outdir = str(outdir)
+    grid = _make_grid(N, **grid_kwargs)
+    shape = tuple(len(val) for val in grid.values())
+
+    cells = {}
+    for idx in itertools.product(*[range(n) for n in shape]):
+        filename = _cell_file(outdir, idx)
+        if os.path.exists(filename):
+            with open(filename, 'rb') as f:
+                cells[idx] = pickle.load(f)
+
+    results_grid = {'grid': grid, 'h': h}
+    if not cells:
+        return results_grid
+
+    for key in next(iter(cells.values())):
+        values = [np.asarray(cell[key]) for cell in cells.values()]
+        if values[0].dtype.kind in 'biuf' and all(v.shape == values[0].shape for v in values):
+            arr = np.full(shape + values[0].shape, np.nan)
+            for idx, cell in cells.items():
+                arr[idx] = cell[key]
+        else:
+            # ragged or non-numeric entries, e.g. chains of different length
+            arr = np.empty(shape, dtype=object)
+            for idx, cell in cells.items():
+                arr[idx] = np.asarray(cell[key])
+        results_grid[key] = arr
+    return results_grid
@@ -1,6 +1,12 @@
 # Code that we need that doesn't produce figures
 
+import os
+import functools
+import importlib.metadata
 import paths
+import numpy as np
+from scipy.interpolate import interp1d
+from bioverse.hypothesis import magma_ocean_hypo, get_avg_deltaR_deltaRho
 
 def save_var_latex(key, value, datafile=paths.tex/'variables.dat'):
     # https://stackoverflow.com/questions/59408823/pdf-latex-with-python-script-custom-python-variables-into-latex-output on 2023-01-13
@@ -24,3 +30,214 @@ def save_var_latex(key, value, datafile=paths.tex/'variables.dat'):
     with open(file_path, "w") as f:
         for key in dict_var.keys():
             f.write(f"{key},{dict_var[key]}\n")
+
+
+f_dR_table_dir = paths.data / 'f_dR_table'
+
+
+def bioverse_version():
+    """version of the installed Bioverse package."""
+    try:
+        return importlib.metadata.version('bioverse')
+    except importlib.metadata.PackageNotFoundError:
+        import bioverse
+        return getattr(bioverse, '__version__', 'unknown')
+
+
+def f_dR_table_file():
+    """file of the extracted f_dR table; it is named after the Bioverse version the table was extracted from."""
+    return f_dR_table_dir / 'bioverse-{}.npz'.format(bioverse_version())
+
+
+@functools.lru_cache(maxsize=None)
+def load_f_dR_table():
+    """Load the table of average radius and density differences for all mechanism combinations.
+
+    The table is extracted once per Bioverse version from `get_avg_deltaR_deltaRho` and stored in
+    src/data/f_dR_table/bioverse-<version>.npz, so that upgrading Bioverse re-extracts it; afterwards it is read
+    once per process.
+
+    Returns
+    -------
+    table : dict
+        arrays 'gh_increase', 'water_incorp', 'wrr', 'delta_R' and 'delta_rho'
+    """
+    filename = f_dR_table_file()
+    if not filename.exists():
+        avg_deltaR_deltaRho = get_avg_deltaR_deltaRho()
+        os.makedirs(f_dR_table_dir, exist_ok=True)
+        with open(filename.with_suffix('.tmp'), 'wb') as f:
+            np.savez(f, **{key: avg_deltaR_deltaRho[key].to_numpy()
+                           for key in ('gh_increase', 'water_incorp', 'wrr', 'delta_R', 'delta_rho')})
+        os.replace(filename.with_suffix('.tmp'), filename)
+
+    with np.load(filename) as table:
+        return {key: table[key] for key in table.files}
+
+
+@functools.lru_cache(maxsize=None)
+def get_f_dR(gh_increase=True, water_incorp=True, parameter_of_interest='R'):
+    """interpolate the average radius/density difference of runaway greenhouse planets as a function of wrr.
+
+    Interpolators are cached per (gh_increase, water_incorp, parameter_of_interest), so that they are built only
+    once per process and shared by all fits.
+
+    Parameters
+    ----------
+    gh_increase : bool
+        consider radius increase due to runaway greenhouse effect (Turbet+2020)
+    water_incorp : bool
+        consider water incorporation in the melt of global magma oceans (Dorn & Lichtenberg 2021)
+    parameter_of_interest : str
+        'R' or 'rho'
+
+    Returns
+    -------
+    f_dR : scipy.interpolate.interp1d
+        average difference in radius/density as a function of the water mass fraction
+    """
+    table = load_f_dR_table()
+    select_mechanisms = (table['gh_increase'] == gh_increase) & (table['water_incorp'] == water_incorp)
+    return interp1d(table['wrr'][select_mechanisms], table['delta_' + parameter_of_interest][select_mechanisms],
+                    fill_value='extrapolate')
+
+
+def magma_ocean_hypo_batch(thetas, a_eff, gh_increase=True, water_incorp=True, simplified=False,
+                           parameter_of_interest='R', f_dR=None, **kwargs):
+    """Evaluate the magma ocean hypothesis for many parameter vectors in one vectorized call.
+
+    The parameter vectors are broadcast against the a_eff grid. If `magma_ocean_hypo` does not support
+    broadcasting (or the result disagrees with a per-draw evaluation), fall back to one call per draw.
+
+    Parameters
+    ----------
+    thetas : array_like
+        (n_draws, 4) array of parameters (S_thresh, wrr, f_rgh, avg)
+    a_eff : array_like
+        grid of effective semi-major axes
+    f_dR : callable
+        average radius/density difference as a function of wrr. Computed once with `get_f_dR` if None.
+    **kwargs
+        further arguments for `magma_ocean_hypo`
+
+    Returns
+    -------
+    prediction : np.ndarray
+        (n_draws, n_grid) array of predicted radii/densities
+    """
+    thetas = np.atleast_2d(thetas)
+    a_eff = np.asarray(a_eff)
+    if f_dR is None:
+        f_dR = get_f_dR(gh_increase, water_incorp, parameter_of_interest)
+    hypo_kwargs = dict(gh_increase=gh_increase, water_incorp=water_incorp, simplified=simplified,
+                       parameter_of_interest=parameter_of_interest, f_dR=f_dR, **kwargs)
+
+    def evaluate(theta):
+        return magma_ocean_hypo(tuple(theta), a_eff, **hypo_kwargs)
+
+    try:
+        columns = tuple(thetas[:, i][:, np.newaxis] for i in range(thetas.shape[1]))
+        prediction = np.broadcast_to(magma_ocean_hypo(columns, a_eff[np.newaxis, :], **hypo_kwargs),
+                                     (len(thetas), len(a_eff)))
+        if all(np.allclose(prediction[i], evaluate(thetas[i]), equal_nan=True) for i in (0, -1)):
+            return np.array(prediction)
+    except (ValueError, TypeError):
+        pass
+    return np.array([evaluate(theta) for theta in thetas])
+
+
+def posterior_predictive_bands(thetas, a_eff, quantiles=(0.16, 0.5, 0.84), weights=None, **kwargs):
+    """Compute quantiles of the posterior predictive of the magma ocean hypothesis.
+
+    Parameters
+    ----------
+    thetas : array_like
+        (n_draws, 4) array of posterior samples
+    a_eff : array_like
+        grid of effective semi-major axes
+    quantiles : tuple
+        quantiles to compute
+    weights : array_like
+        importance weights of the samples (e.g. from nested sampling). Equal weights if None.
+    **kwargs
+        arguments for `magma_ocean_hypo_batch`
+
+    Returns
+    -------
+    bands : np.ndarray
+        (len(quantiles), n_grid) array
+    """
+    prediction = magma_ocean_hypo_batch(thetas, a_eff, **kwargs)
+    if weights is None:
+        return np.quantile(prediction, quantiles, axis=0)
+
+    # weighted quantiles along the draws axis
+    order = np.argsort(prediction, axis=0)
+    sorted_prediction = np.take_along_axis(prediction, order, axis=0)
+    cdf = np.cumsum(np.asarray(weights)[order], axis=0)
+    cdf /= cdf[-1]
+    idx = np.array([np.minimum((cdf < q).sum(axis=0), len(cdf) - 1) for q in quantiles])
+    return np.take_along_axis(sorted_prediction, idx, axis=0)
+
+
+def adaptive_fit(h, data, nlive_min=50, nlive_max=500, dlnZ_tol=0.5, threshold=3., n_sigma=3., **fit_kwargs):
+    """Fit a hypothesis with nested sampling, growing the number of live points only while necessary.
+
+    Start with `nlive_min` live points and double them until either the uncertainty of dlnZ drops below
+    `dlnZ_tol`, or the verdict at the detection threshold is certain (dlnZ is more than `n_sigma` uncertainties
+    away from `threshold`), or `nlive_max` is reached. The uncertainty of dlnZ is estimated from the evidence
+    uncertainty of the hypothesis; the null hypothesis has a single parameter, its evidence is much better constrained.
+
+    Every doubling reruns the fit from scratch. Since the cost of nested sampling grows about linearly with the
+    number of live points, a doubling that would push the summed likelihood evaluations of all fits above those of
+    a single fit with `nlive_max` live points is skipped, and the last fit is run with `nlive_max` live points right
+    away. Fits that end without meeting `dlnZ_tol` or a certain verdict are marked as not converged.
+
+    Parameters
+    ----------
+    h : Bioverse Hypothesis
+        hypothesis to fit, including its null hypothesis
+    data : Table
+        simulated measurements
+    nlive_min, nlive_max : int
+        initial and maximum number of live points
+    dlnZ_tol : float
+        target uncertainty of dlnZ
+    threshold : float
+        detection threshold in dlnZ
+    n_sigma : float
+        number of uncertainties dlnZ must be away from the threshold for a certain verdict
+    **fit_kwargs
+        further arguments for `Hypothesis.fit`
+
+    Returns
+    -------
+    results : dict
+        results of the last fit, with additional keys 'nlive', 'dlnZ_err', 'converged' (whether the tolerance was
+        met or the verdict is certain), 'ncall_total' (likelihood evaluations summed over all fits) and 'ncall_fixed'
+        (estimated likelihood evaluations of a single fit with `nlive_max` live points)
+    """
+    nlive = nlive_min
+    ncall_total = 0
+    while True:
+        results = h.fit(data, return_chains=True, nlive=nlive, sampler_results=True, **fit_kwargs)
+        ncall = int(np.sum(results['sampler_results'].ncall))
+        ncall_total += ncall
+        ncall_fixed = ncall * nlive_max / nlive
+        dlnZ_err = results['sampler_results'].logzerr[-1]
+        decided = np.abs(results['dlnZ'] - threshold) > n_sigma * dlnZ_err
+        converged = dlnZ_err <= dlnZ_tol or decided
+        if converged or nlive >= nlive_max:
+            break
+        nlive_next = min(2 * nlive, nlive_max)
+        if ncall_total + ncall * nlive_next / nlive > ncall_fixed:
+            # further doublings would cost more than the fixed budget; go straight to it
+            nlive_next = nlive_max
+        nlive = nlive_next
+
+    results['nlive'] = nlive
+    results['dlnZ_err'] = dlnZ_err
+    results['converged'] = bool(converged)
+    results['ncall_total'] = ncall_total
+    results['ncall_fixed'] = int(ncall_fixed)
+    return results